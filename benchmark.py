@@ -0,0 +1,361 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for python-genieacs
+#
+#   python benchmark.py decode [--devices 100 1000 10000]
+#   python benchmark.py models [--devices 10000]
+#   python benchmark.py nbi [--devices 10000] [--latency 0.002] [--operations list_ids params ...]
+#   python benchmark.py threads [--threads 32] [--pool-maxsize 4]
+#
+# The nbi benchmarks run against mocknbi.py started in a separate process,
+# every operation runs in a fresh process of its own so its peak RSS can be
+# reported. threads checks that one Connection shared by many threads gives
+# every caller correct results, it exits with status 1 if one did not.
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+import genieacs
+import mocknbi
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    return rss / 1024.0
+
+
+def decode_response(body):
+    r = requests.Response()
+    r.status_code = 200
+    r.headers["Content-Type"] = "application/json; charset=utf-8"
+    r.encoding = "utf-8"
+    r._content = body
+    return r
+
+
+def bench_decode(args):
+    """Compare the old r.text/r.json() decoding with parsing the response bytes"""
+    print("JSON backend: " + genieacs._json_loads.__module__)
+    print("%10s %8s %14s %16s %16s %8s" % ("devices", "MB", "r.json() ms", "json bytes ms", "backend ms", "speedup"))
+    for count in args.devices:
+        body = json.dumps([mocknbi.synthetic_device(index) for index in range(count)]).encode("utf-8")
+        r = decode_response(body)
+
+        def before():
+            if r.text:
+                r.json()
+
+        def stdlib():
+            if r.content:
+                json.loads(r.content)
+
+        def after():
+            if r.content:
+                genieacs._json_loads(r.content)
+
+        old = best_of(before, args.repeat)
+        plain = best_of(stdlib, args.repeat)
+        new = best_of(after, args.repeat)
+        print("%10d %8.1f %14.1f %16.1f %16.1f %7.1fx" % (count, len(body) / 1e6, old * 1e3, plain * 1e3, new * 1e3, old / new))
+
+
+def traced_bytes(func):
+    # memory still allocated by the result of func
+    tracemalloc.start()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_models(args):
+    """Compare the memory of decoded device documents with Device models holding them"""
+    path = "InternetGatewayDevice.DeviceInfo.SoftwareVersion"
+    body = json.dumps([mocknbi.synthetic_device(index) for index in range(args.devices)]).encode("utf-8")
+
+    def dicts():
+        return genieacs._json_loads(body)
+
+    def models():
+        return [genieacs.Device(document) for document in genieacs._json_loads(body)]
+
+    def lookup_dicts():
+        for document in documents:
+            document["InternetGatewayDevice"]["DeviceInfo"]["SoftwareVersion"]["_value"]
+
+    def lookup_models():
+        for device in devices:
+            device.value(path)
+
+    documents, dict_bytes = traced_bytes(dicts)
+    dict_lookup = best_of(lookup_dicts, 3)
+    del documents
+    devices, model_bytes = traced_bytes(models)
+    model_first = best_of(lookup_models, 1)
+    model_lookup = best_of(lookup_models, 3)
+    devices, accessed_bytes = traced_bytes(lambda: [device for device in models() if device.value(path) or True])
+    del devices
+
+    print("JSON backend: " + genieacs._json_loads.__module__)
+    print("%-24s %14s %12s %18s %18s" % ("", "bytes/device", "total MB", "first lookup ms", "next lookups ms"))
+    print("%-24s %14d %12.1f %18.1f %18.1f" % ("dicts", dict_bytes / args.devices, dict_bytes / 1e6,
+                                               dict_lookup * 1e3, dict_lookup * 1e3))
+    print("%-24s %14d %12.1f %18.1f %18.1f" % ("Device", model_bytes / args.devices, model_bytes / 1e6,
+                                               model_first * 1e3, model_lookup * 1e3))
+    print("%-24s %14d %12.1f" % ("Device, after a lookup", accessed_bytes / args.devices, accessed_bytes / 1e6))
+    print("Device models use %.1fx less memory, %.1fx after a lookup on every device"
+          % (float(dict_bytes) / model_bytes, float(dict_bytes) / accessed_bytes))
+
+
+##### operations against the fake NBI #####
+# each takes a Connection and the parsed arguments, returns the number of items processed
+
+def op_list_ids(acs, args):
+    return len(acs.device_get_all_IDs())
+
+
+def op_list_devices(acs, args):
+    count = 0
+    for device in acs.device_iter(page_size=args.page_size):
+        count += 1
+    return count
+
+
+def op_params(acs, args):
+    parameters = ["InternetGatewayDevice.DeviceInfo.SoftwareVersion",
+                  "InternetGatewayDevice.WANDevice.1.WANConnectionDevice.1.WANIPConnection.1.ExternalIPAddress"]
+    device_ids = acs.device_get_all_IDs()
+    return len(acs.device_get_parameters_bulk(device_ids, parameters, workers=args.workers))
+
+
+def op_tasks(acs, args):
+    device_ids = acs.device_get_all_IDs()
+    return len(acs.task_bulk({"name": "reboot"}, device_ids, workers=args.workers))
+
+
+def op_presets(acs, args):
+    presets = []
+    for index in range(args.presets):
+        presets.append({"_id": "preset-%d" % index, "weight": index, "channel": "bench",
+                        "precondition": json.dumps({"_tags": "batch%d" % (index % 10)}),
+                        "configurations": [{"type": "add_tag", "tag": "preset-%d" % index}]})
+    # create all presets, then change every tenth one: the second sync
+    # compares all of them and writes only the changed ones
+    created = acs.preset_sync(presets, workers=args.workers)
+    for preset in presets[::10]:
+        preset["weight"] += args.presets
+    updated = acs.preset_sync(presets, workers=args.workers)
+    if created["failed"] or updated["failed"]:
+        raise RuntimeError("preset sync failed: %r" % dict(created["failed"], **updated["failed"]))
+    return len(created["created"]) + len(updated["updated"])
+
+
+def op_upload(acs, args):
+    with tempfile.NamedTemporaryFile(suffix=".img", delete=False) as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.file_size):
+            f.write(block)
+    try:
+        os.chdir(os.path.dirname(f.name))
+        acs.file_upload(os.path.basename(f.name), "1 Firmware Upgrade Image", "000149", "r4500", "1.0")
+        return args.file_size
+    finally:
+        os.unlink(f.name)
+
+
+OPERATIONS = {
+    "list_ids": (op_list_ids, "device IDs"),
+    "list_devices": (op_list_devices, "devices"),
+    "params": (op_params, "devices"),
+    "tasks": (op_tasks, "tasks"),
+    "presets": (op_presets, "presets"),
+    "upload": (op_upload, "MB"),
+}
+
+
+def run_operation(name, port, args, queue):
+    # runs in its own process, reports its results through queue
+    acs = genieacs.Connection("127.0.0.1", port=port, pool_maxsize=max(10, args.workers))
+    latencies = []
+    acs.add_hook(lambda metrics: latencies.append(metrics.total))
+    func = OPERATIONS[name][0]
+    started = time.perf_counter()
+    items = func(acs, args)
+    elapsed = time.perf_counter() - started
+    queue.put({
+        "operation": name,
+        "items": items,
+        "unit": OPERATIONS[name][1],
+        "seconds": elapsed,
+        "throughput": items / elapsed if elapsed else 0.0,
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1e3,
+        "p99_ms": percentile(latencies, 0.99) * 1e3,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+
+
+def start_nbi(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mocknbi.py"),
+               "--port", "0", "--devices", str(args.devices), "--latency", str(args.latency)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith("listening on"):
+        process.kill()
+        raise RuntimeError("mocknbi did not start")
+    return process, int(line.rsplit(":", 1)[1])
+
+
+def bench_nbi(args):
+    """Time the main client operations against a fake NBI"""
+    process, port = start_nbi(args)
+    results = []
+    try:
+        print("%d devices, %.1f ms NBI latency, %d workers" % (args.devices, args.latency * 1e3, args.workers))
+        print("%-13s %10s %10s %14s %9s %9s %9s %9s" % ("operation", "items", "seconds", "items/s", "requests",
+                                                       "p50 ms", "p99 ms", "RSS MB"))
+        for name in args.operations:
+            queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=run_operation, args=(name, port, args, queue))
+            worker.start()
+            result = queue.get()
+            worker.join()
+            results.append(result)
+            print("%-13s %10d %10.2f %14.1f %9d %9.2f %9.2f %9.1f" % (
+                name, result["items"], result["seconds"], result["throughput"], result["requests"],
+                result["p50_ms"], result["p99_ms"], result["peak_rss_mb"]))
+    finally:
+        process.terminate()
+        process.wait()
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                result.update({"devices": args.devices, "latency": args.latency, "workers": args.workers,
+                               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")})
+                f.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+def check_threads(args):
+    """Share one Connection with a small pool, the response cache and hooks between many threads"""
+    errors = []
+    requests_seen = []
+    tasks = []
+    with mocknbi.MockNBI(devices=args.devices) as nbi:
+        device_ids = sorted(nbi.collections["devices"])
+        nbi.collections["presets"]["inform"] = {"_id": "inform", "weight": 0, "channel": "bench"}
+        acs = genieacs.Connection("127.0.0.1", port=nbi.port, pool_maxsize=args.pool_maxsize, cache_ttl=60)
+        collector = genieacs.MetricsCollector()
+        acs.add_hook(collector)
+        acs.add_hook(requests_seen.append)
+
+        def caller(index):
+            try:
+                for iteration in range(args.iterations):
+                    device_id = device_ids[(index * args.iterations + iteration) % len(device_ids)]
+                    if sorted(acs.device_get_all_IDs()) != device_ids:
+                        errors.append("thread %d: wrong device IDs" % index)
+                    if acs.device_get_by_id(device_id)[0]["_id"] != device_id:
+                        errors.append("thread %d: wrong device for %s" % (index, device_id))
+                    if [preset["_id"] for preset in acs.preset_get_all()] != ["inform"]:
+                        errors.append("thread %d: wrong presets" % index)
+                    result = acs.task_create(device_id, {"name": "reboot"})
+                    if result["status"] not in ("executed", "queued"):
+                        errors.append("thread %d: task %s" % (index, result))
+                    tasks.append(result["task"]["_id"])
+            except Exception as err:
+                errors.append("thread %d: %r" % (index, err))
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=caller, args=(index,)) for index in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    expected = args.threads * args.iterations
+    if len(set(tasks)) != expected:
+        errors.append("%d distinct tasks created, expected %d" % (len(set(tasks)), expected))
+    # every request reaches both hooks, cached presets need at most one
+    # request per thread until the TTL expires
+    counted = sum(series["count"] for series in collector.series.values())
+    if counted != len(requests_seen):
+        errors.append("MetricsCollector counted %d requests, the other hook %d" % (counted, len(requests_seen)))
+    if len(requests_seen) > 3 * expected + args.threads:
+        errors.append("%d requests, the preset cache was bypassed" % len(requests_seen))
+    print("%d threads, %d calls each, pool of %d connections: %d requests in %.2f s"
+          % (args.threads, args.iterations * 4, args.pool_maxsize, len(requests_seen), elapsed))
+    for error in errors[:20]:
+        print(error)
+    if errors:
+        print("FAILED: %d errors" % len(errors))
+        sys.exit(1)
+    print("OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="python-genieacs benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    decode = subparsers.add_parser("decode", help="JSON decoding of device listings")
+    decode.add_argument("--devices", type=int, nargs="+", default=[100, 1000, 10000])
+    decode.add_argument("--repeat", type=int, default=5)
+    decode.set_defaults(func=bench_decode)
+    models = subparsers.add_parser("models", help="memory of device models compared to decoded documents")
+    models.add_argument("--devices", type=int, default=10000)
+    models.set_defaults(func=bench_models)
+    nbi = subparsers.add_parser("nbi", help="client operations against a fake NBI")
+    nbi.add_argument("--devices", type=int, default=10000)
+    nbi.add_argument("--latency", type=float, default=0.002, help="NBI delay per request in seconds")
+    nbi.add_argument("--workers", type=int, default=16)
+    nbi.add_argument("--page-size", type=int, default=1000)
+    nbi.add_argument("--presets", type=int, default=200)
+    nbi.add_argument("--file-size", type=int, default=64, help="size of the uploaded file in MB")
+    nbi.add_argument("--operations", nargs="+", choices=sorted(OPERATIONS),
+                     default=["list_ids", "list_devices", "params", "tasks", "presets", "upload"])
+    nbi.add_argument("--output", help="append the results as JSON lines to this file")
+    nbi.set_defaults(func=bench_nbi)
+    threads = subparsers.add_parser("threads", help="check one Connection shared by many threads")
+    threads.add_argument("--devices", type=int, default=100)
+    threads.add_argument("--threads", type=int, default=32)
+    threads.add_argument("--iterations", type=int, default=20)
+    threads.add_argument("--pool-maxsize", type=int, default=4)
+    threads.set_defaults(func=check_threads)
+    args = parser.parse_args()
+    if not hasattr(args, "func"):
+        parser.error("choose a benchmark")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
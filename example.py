@@ -3,6 +3,8 @@
 #
 # Usage examples for python-genieacs
 
+from __future__ import print_function
+
 import genieacs
 
 # set a device_id for the following methods
@@ -10,6 +12,15 @@ device_id = "000149-c1500-000149014AF8"
 
 # Create a Connection object to interact with a GenieACS server
 acs = genieacs.Connection("tr069.tdt.de", ssl=True, auth=True, user="tdt", passwd="tdt")
+# a Connection shared by 32 threads: keep up to 32 connections alive and retry failed GETs twice
+# shared_acs = genieacs.Connection("tr069.tdt.de", ssl=True, pool_maxsize=32, pool_block=True, retries=2, backoff_factor=0.5)
+# cache presets for 5 minutes and files for one minute, other resources are not cached
+# cached_acs = genieacs.Connection("tr069.tdt.de", ssl=True, cache_ttl={"presets": 300, "files": 60})
+# spread the requests over three NBI nodes, preferring the fastest and skipping failing ones
+# cluster_acs = genieacs.ClusterConnection(["nbi1.tdt.de", "nbi2.tdt.de", "nbi3.tdt.de:7557"], ssl=True, strategy="least_latency", health_interval=10)
+
+# test the connection, constructing it did not contact the server
+print("NBI answered in %.1f ms" % (acs.ping() * 1000))
 
 # refresh some device parameters
 acs.task_refresh_object(device_id, "InternetGatewayDevice.DeviceInfo.")
@@ -25,14 +36,60 @@ acs.task_reboot(device_id)
 acs.task_add_object(device_id, "VPNObject", [["InternetGatewayDevice.X_TDT-DE_OpenVPN"]])
 # download a file
 acs.task_download(device_id, "9823de165bb983f24f782951", "Firmware.img")
+# download a firmware to all devices of a product class, 16 at a time and at most 20 per second
+results = acs.task_bulk({"name": "download", "file": "9823de165bb983f24f782951", "filename": "Firmware.img"},
+                        query={"_deviceId._ProductClass": "r4500"}, workers=16, rate=20)
+for bulk_device_id, result in results.items():
+    if result["status"] not in ("executed", "queued"):
+        print(bulk_device_id + ": " + result["status"])
 # retry a faulty task
 acs.task_retry("9h4769svl789kjf984ll")
 
 
+# refresh all devices and reboot the staged ones first, waking up at most 50 devices per second and 5 r4500 per second
+scheduler = genieacs.ConnectionRequestScheduler(acs, rate=50, group_rates={"r4500": 5}, group_by=lambda device_id: device_id.split("-")[1],
+                                                priorities={"reboot": 10})
+scheduler.submit_all(acs.device_get_all_IDs(), {"name": "refreshObject", "objectName": "InternetGatewayDevice.DeviceInfo"})
+scheduler.submit_all((device["_id"] for device in acs.device_iter({"_tags": "staged"}, "_id")), {"name": "reboot"})
+for bulk_device_id, result in scheduler.run_iter():
+    print(bulk_device_id + " " + result["status"])
+# reboot a product class without connection requests and wait up to an hour for the devices to execute the tasks
+tracker = genieacs.TaskTracker(acs, timeout=3600)
+futures = tracker.track_bulk(acs.task_bulk({"name": "reboot"}, query={"_deviceId._ProductClass": "r4500"}, conn_request=False))
+tracker.run()
+for bulk_device_id, future in futures.items():
+    print(bulk_device_id + " " + future.result()["status"])
 # print all tasks of a given device
 print(acs.task_get_all(device_id))
 # print IDs of all devices
 print(acs.device_get_all_IDs())
+# walk all devices of a product class page by page, fetching only two fields
+for device in acs.device_iter({"_deviceId._ProductClass": "r4500"}, ["_id", "_lastInform"], page_size=500):
+    print(device["_id"] + " " + device["_lastInform"])
+# count the r4500 devices which have not informed for a day and print the 10 longest silent ones
+stale = genieacs.Query().product_class("r4500").informed_before(86400).select("_id", "_lastInform")
+print(acs.device_count(stale))
+for device in acs.device_iter(stale.sort("_lastInform").limit(10)):
+    print(device["_id"] + " " + device["_lastInform"])
+# how many devices run which firmware, how many of them are r4500 and how long ago did they inform
+print(acs.device_group_by("InternetGatewayDevice.DeviceInfo.SoftwareVersion"))
+print(acs.device_group_by("InternetGatewayDevice.DeviceInfo.SoftwareVersion", genieacs.Query().product_class("r4500"), values=["2.0.0", "2.1.0"]))
+print(acs.device_inform_ages(buckets=[300, 3600, 86400]))
+# keep all devices in memory as compact Device models and print the external IP addresses of each
+devices = list(acs.device_iter(model=True))
+for device in devices:
+    for parameter in device.find("InternetGatewayDevice.WANDevice.*.WANConnectionDevice.*.WANIPConnection.*.ExternalIPAddress"):
+        print(device.id + " " + parameter.name + " " + str(parameter.value))
+# print devices which informed since the last run, the watcher state is kept in watcher.db
+watcher = genieacs.DeviceWatcher(acs, "InternetGatewayDevice.DeviceInfo.SoftwareVersion", checkpoint="watcher.db")
+for event, device in watcher.poll():
+    print(event + " " + device["_id"])
+watcher.close()
+# copy the fleet into a local SQLite database and count the staged r4500 devices offline
+snapshot = genieacs.DeviceSnapshot("devices.db", "InternetGatewayDevice.DeviceInfo.SoftwareVersion")
+snapshot.refresh(acs)
+print(snapshot.count(product_class="r4500", tag="staged"))
+snapshot.close()
 # search a device by its ID and print all corresponding data
 print(acs.device_get_by_id(device_id))
 # search a device by its MAC address and print all corresponding data
@@ -41,6 +98,11 @@ print(acs.device_get_by_MAC("00:01:49:ff:0f:01"))
 print(acs.device_get_parameter(device_id, "InternetGatewayDevice.DeviceInfo.SoftwareVersion"))
 # print 2 given parameters of a given device
 print(acs.device_get_parameters(device_id, "InternetGatewayDevice.DeviceInfo.SoftwareVersion,InternetGatewayDevice.X_TDT-DE_Interface.2.ProtoStatic.Ipv4.Address"))
+# print the software version and WAN IP of many devices, fetched 200 devices per request
+versions = acs.device_get_parameters_bulk(acs.device_get_all_IDs(), ["InternetGatewayDevice.DeviceInfo.SoftwareVersion", "InternetGatewayDevice.WANDevice.1.WANConnectionDevice.1.WANIPConnection.1.ExternalIPAddress"], chunk_size=200)
+print(versions)
+# print 2 given parameters of a given device keyed by their full names
+print(acs.device_get_parameters(device_id, "InternetGatewayDevice.DeviceInfo.SoftwareVersion,InternetGatewayDevice.DeviceInfo.UpTime", flat=True))
 # delete a task
 acs.task_delete("9h4769svl789kjf984ll")
 
@@ -54,6 +116,10 @@ for preset in preset_data:
 # create all presets from the file
 acs.preset_create_all_from_file('presets.json')
 
+# show what syncing the config files would change, then apply it and delete what is not in the files
+print(acs.config_sync(presets='presets.json', objects='objects.json', provisions='provisions.json', delete=True, dry_run=True))
+report = acs.config_sync(presets='presets.json', objects='objects.json', provisions='provisions.json', delete=True)
+
 # create a new object
 acs.object_create("CreatedObject", r'{"Param1": "Value1", "Param2": "Value2", "_keys":["Param1"]}')
 # write all existing objects to a file and store them in a json object
@@ -80,6 +146,8 @@ print(acs.tag_get_all(device_id))
 acs.tag_assign(device_id, "tagged")
 # remove a tag from a device
 acs.tag_remove(device_id, "tagged")
+# move all staged r4500 devices into the first rollout wave
+results = acs.tag_bulk(assign="wave1", remove="staged", query={"_deviceId._ProductClass": "r4500", "_tags": "staged"}, workers=16)
 
 # print all existing files in the database
 print(acs.file_get_all())
@@ -87,12 +155,24 @@ print(acs.file_get_all())
 print(str(acs.file_get(fileType="12 Other File", version="0.4")))
 # upload a new or modified file
 acs.file_upload("Firmware.img", "1 Firmware Upgrade Image", "123456", "r4500", "2.0")
+# upload a file and report the progress
+acs.file_upload("Firmware.img", "1 Firmware Upgrade Image", "123456", "r4500", "2.0", progress=lambda sent, size: print(str(sent) + "/" + str(size)))
+# download a file from the database
+acs.file_download("Firmware.img", "Firmware-copy.img")
+# stage two firmware images at once
+acs.file_upload_all([("Firmware-r4500.img", "1 Firmware Upgrade Image", "123456", "r4500", "2.0"),
+                     ("Firmware-r4600.img", "1 Firmware Upgrade Image", "123456", "r4600", "2.0")])
 # delete a file from the database
 acs.file_delete("Firmware.img")
 
 # delete the device from the database
 acs.device_delete(device_id)
 
+# after an outage: count the download faults older than an hour, retry them and delete the remaining timeouts
+print(acs.fault_summary(code=["cwmp.9010", "cwmp.9002"], older_than=3600))
+print(acs.fault_bulk("retry", code=["cwmp.9010", "cwmp.9002"], older_than=3600, workers=16, rate=200))
+print(acs.fault_bulk("delete", code="timeout", workers=16))
+
 # get IDs of all existing faults and delete all
 faults = acs.fault_get_all_IDs()
 for fault in faults:
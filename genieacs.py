@@ -5,11 +5,136 @@
 # https://github.com/TDT-GmbH/python-genieacs
 
 import requests
+import requests.adapters
+import datetime
+import functools
+import hashlib
+import heapq
 import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    def _json_dumps(obj):
+        # orjson returns its oversized write buffer, copy it to the exact size
+        return memoryview(orjson.dumps(obj)).tobytes()
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+# the cheapest query the NBI answers: the ID of at most one device
+_PING_PARAMS = {"projection": "_id", "limit": 1}
+
+# time spent opening connections (name lookup, TCP and TLS handshake)
+# during the current request of each thread
+_connect_timing = threading.local()
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.time()
+        try:
+            super(_TimedHTTPConnection, self).connect()
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.time() - started
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.time()
+        try:
+            super(_TimedHTTPSConnection, self).connect()
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.time() - started
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _PoolAdapter(requests.adapters.HTTPAdapter):
+    # HTTPAdapter which optionally turns on TCP keep-alive for pooled sockets
+    def __init__(self, keepalive=True, **kwargs):
+        self.socket_options = list(HTTPConnection.default_socket_options)
+        if keepalive:
+            self.socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for option, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 20), ("TCP_KEEPCNT", 3)):
+                if hasattr(socket, option):
+                    self.socket_options.append((socket.IPPROTO_TCP, getattr(socket, option), value))
+        super(_PoolAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super(_PoolAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool,
+                                                   "https": _TimedHTTPSConnectionPool}
+
+def _retry_policy(retries, backoff_factor):
+    # retry only idempotent requests, keep the last response on exhausted
+    # status retries so raise_for_status() reports it as usual
+    options = {"total": retries, "backoff_factor": backoff_factor,
+               "status_forcelist": (502, 503, 504), "raise_on_status": False}
+    try:
+        return Retry(allowed_methods=frozenset(["GET", "HEAD"]), **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(["GET", "HEAD"]), **options)
 
 class Connection(object):
-    """Connection object to interact with the GenieACS server."""
-    def __init__(self, ip, port=7557, ssl=False, verify=False, auth=False, user="", passwd="", url="", timeout=10):
+    """Connection object to interact with the GenieACS server.
+
+    All requests go through one session with a pool of keep-alive
+    connections, so TCP and TLS handshakes are only paid when a new
+    connection is opened. A Connection may be shared between threads, the
+    pool, the response cache and the hooks included (python benchmark.py
+    threads checks this); size pool_maxsize to the number of threads using
+    it, otherwise surplus connections are closed after each request (or,
+    with pool_block=True, threads wait for a free connection). retries and
+    backoff_factor set how often idempotent requests (GET, HEAD) are
+    retried on connection errors and 502, 503 and 504 responses.
+    keepalive enables TCP keep-alive probes so idle pooled connections
+    survive NAT and firewall timeouts.
+
+    cache_ttl enables caching of the rarely changing presets, objects,
+    provisions, files and tags: either one TTL in seconds for all of them
+    or a dict like {"presets": 300, "files": 60}. At most cache_size
+    responses are kept, the least recently used are evicted first. Expired
+    entries are revalidated with If-None-Match/If-Modified-Since when the
+    server sent an ETag or Last-Modified header. Creating or deleting items
+    through this Connection drops the cached responses of their kind.
+    Cached data is shared between callers and must not be modified.
+
+    add_hook() registers callables which receive a RequestMetrics object
+    with status, sizes and timings of every request.
+
+    Responses are parsed with orjson if it is installed, else with the
+    standard json module; json_loads replaces the parser with any function
+    taking the response bytes.
+
+    Creating a Connection does no network I/O, the first request opens the
+    first connection. ping() tests the connection explicitly, probe=True
+    does so right away and raises ConnectionError if the server can not be
+    reached.
+    """
+    def __init__(self, ip, port=7557, ssl=False, verify=False, auth=False, user="", passwd="", url="", timeout=10,
+                 pool_connections=10, pool_maxsize=10, pool_block=False, retries=0, backoff_factor=0, keepalive=True,
+                 cache_ttl=None, cache_size=256, json_loads=None, probe=False):
         self.server_ip = ip
         self.server_port = port
         self.use_ssl = ssl
@@ -19,10 +144,23 @@ class Connection(object):
         self.password = passwd
         self.server_url = url
         self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.keepalive = keepalive
+        self.json_loads = json_loads or _json_loads
+        self.hooks = []
+        self.cache = None
+        if cache_ttl is not None:
+            self.cache = _ResponseCache(cache_ttl, cache_size)
         self.base_url = ""
         self.session = None
         self.__set_base_url()
         self.__create_session()
+        if probe:
+            self.ping()
 
     def __set_base_url(self):
         if not self.use_ssl:
@@ -38,133 +176,293 @@ class Connection(object):
                 self.session.auth = (self.username, self.password)
             if self.use_ssl:
                 self.session.verify = self.ssl_verify
+            adapter = _PoolAdapter(keepalive=self.keepalive,
+                                   pool_connections=self.pool_connections,
+                                   pool_maxsize=self.pool_maxsize,
+                                   pool_block=self.pool_block,
+                                   max_retries=_retry_policy(self.retries, self.backoff_factor))
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    def ping(self):
+        """Test the connection with a query for a single device ID, return the round trip time in seconds"""
+        started = time.time()
+        self.__request_get("/devices/", _PING_PARAMS)
+        return time.time() - started
+
+    def __request(self, method, url, decode=False, **kwargs):
+        # returns the response and, with decode set, its parsed JSON body.
+        # The body is parsed straight from the response bytes, r.text would
+        # decode it to a str first.
+        started = time.time()
+        _connect_timing.seconds = 0.0
+        r = None
+        data = None
+        decode_time = 0.0
         try:
-            # do a request to test the connection
-            self.file_get_all()
+            r = self._send(method, url, **kwargs)
+            if decode and r.ok and r.content:
+                decode_started = time.time()
+                data = self.json_loads(r.content)
+                decode_time = time.time() - decode_started
+            return r, data
+        finally:
+            if self.hooks:
+                self.__report(method, url, kwargs, r, started, decode_time)
+
+    def _send(self, method, url, **kwargs):
+        # send a request to the NBI, ClusterConnection overrides this to pick a node
+        return self.session.request(method, self.base_url + url, timeout=self.timeout, **kwargs)
+
+    def __report(self, method, url, kwargs, r, started, decode_time):
+        total = time.time() - started
+        connect = _connect_timing.seconds
+        metrics = RequestMetrics(method, _endpoint_template(url), url)
+        metrics.connect = connect
+        metrics.decode = decode_time
+        metrics.total = total
+        if r is not None:
+            metrics.status = r.status_code
+            metrics.ttfb = max(r.elapsed.total_seconds() - connect, 0.0)
+            body = r.request.body
+            if body is not None and hasattr(body, "__len__"):
+                metrics.bytes_out = len(body)
+            if kwargs.get("stream"):
+                metrics.bytes_in = int(r.headers.get("Content-Length") or 0)
+            else:
+                metrics.bytes_in = len(r.content)
+        for hook in self.hooks:
+            hook(metrics)
+
+    def add_hook(self, hook):
+        """Call hook with a RequestMetrics object after every request, e.g. a MetricsCollector"""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Stop calling a hook added with add_hook"""
+        self.hooks.remove(hook)
+
+    def __request_get(self, url, params=None, raw=False):
+        try:
+            r, data = self.__request("GET", url, decode=not raw, params=params)
+            r.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
             raise ConnectionError
+        if raw:
+            return r.content
+        return data
 
-    def __request_get(self, url):
-        request_url = self.base_url + url
+    def __request_get_cached(self, resource, url, params=None):
+        if self.cache is None or self.cache.ttl_for(resource) is None:
+            return self.__request_get(url, params)
+        key = (url, tuple(sorted((params or {}).items())))
+        entry = self.cache.get(key)
+        if entry is not None and entry.expires > time.time():
+            return entry.data
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
         try:
-            r = self.session.get(request_url, timeout=self.timeout)
+            r, data = self.__request("GET", url, decode=True, params=params, headers=headers)
+            if r.status_code == 304 and entry is not None:
+                self.cache.put(resource, key, entry.data, entry.etag, entry.last_modified)
+                return entry.data
             r.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
             raise ConnectionError
-        if r.text:
-            data = r.json()
-            return data
+        self.cache.put(resource, key, data, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        return data
+
+    def __invalidate(self, resource):
+        if self.cache is not None:
+            self.cache.invalidate(resource)
+
+    def cache_clear(self, resource=None):
+        """Drop all cached responses, or only those of one resource (presets, objects, provisions, files, tags)"""
+        if self.cache is not None:
+            self.cache.invalidate(resource)
+
+    def __request_iter(self, url, query=None, projection=None, page_size=1000):
+        # keyset pagination: walk the collection ordered by _id and continue
+        # each page after the last _id seen, so every page is a cheap indexed
+        # range query no matter how deep into the collection we are
+        limit = None
+        order = ()
+        if isinstance(query, Query):
+            if projection is None:
+                projection = query.projection
+            limit = query.max_items
+            order = query.order
+            query = query.filter
+        elif query is not None and not isinstance(query, dict):
+            query = json.loads(query)
+        if isinstance(projection, (list, tuple)):
+            projection = ",".join(projection)
+        if limit is not None:
+            page_size = min(page_size, limit)
+            if not page_size:
+                return
+        if order:
+            # other sort orders can only be paged with skip
+            for document in self.__request_iter_skip(url, query, projection, page_size, limit, order):
+                yield document
+            return
+        params = {"sort": json.dumps({"_id": 1}), "limit": page_size}
+        if projection:
+            params["projection"] = projection
+        page_query = query
+        count = 0
+        while True:
+            if page_query:
+                params["query"] = json.dumps(page_query)
+            page = self.__request_get(url, params)
+            if not page:
+                return
+            for document in page:
+                yield document
+                count += 1
+                if count == limit:
+                    return
+            if len(page) < page_size:
+                return
+            after = {"_id": {"$gt": page[-1]["_id"]}}
+            if query:
+                page_query = {"$and": [query, after]}
+            else:
+                page_query = after
+
+    def __request_iter_skip(self, url, query, projection, page_size, limit, order):
+        params = {"sort": json.dumps(OrderedDict(order)), "limit": page_size}
+        if projection:
+            params["projection"] = projection
+        if query:
+            params["query"] = json.dumps(query)
+        count = 0
+        while True:
+            params["skip"] = count
+            page = self.__request_get(url, params)
+            if not page:
+                return
+            for document in page:
+                yield document
+                count += 1
+                if count == limit:
+                    return
+            if len(page) < page_size:
+                return
+
+    def __request_count(self, url, query):
+        # the NBI answers HEAD requests with the number of matches in X-Total-Count
+        if isinstance(query, Query):
+            query = query.filter
+        elif query is not None and not isinstance(query, dict):
+            query = json.loads(query)
+        params = {"query": json.dumps(query)} if query else None
+        try:
+            r, _ = self.__request("HEAD", url, params=params)
+            r.raise_for_status()
+        except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
+            raise ConnectionError
+        total = r.headers.get("X-Total-Count")
+        if total is not None:
+            return int(total)
+        return sum(1 for _ in self.__request_iter(url, query, "_id"))
 
     def __request_post(self, url, data, conn_request=True):
         if conn_request:
-            request_url = self.base_url + url + "?connection_request"
-        else:
-            request_url = self.base_url + url
+            url += "?connection_request"
         try:
-            r = self.session.post(request_url, json=data, timeout=self.timeout)
+            r, data = self.__request("POST", url, decode=True, json=data)
             r.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
             raise ConnectionError
-        if r.text:
-            data = r.json()
-            return data
+        return data
 
     def __request_put(self, url, data, headers=None):
-        request_url = self.base_url + url
         try:
-            if headers is not None:
-                r = self.session.put(request_url, data, timeout=self.timeout, headers=headers)
-            else:
-                r = self.session.put(request_url, data, timeout=self.timeout)
+            r, data = self.__request("PUT", url, decode=True, data=data, headers=headers)
             r.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
             raise ConnectionError
-        if r.text:
-            data = r.json()
-            return data
+        return data
 
     def __request_delete(self, url):
-        request_url = self.base_url + url
         try:
-            r = self.session.delete(request_url, timeout=self.timeout)
+            r, data = self.__request("DELETE", url, decode=True)
             r.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
             raise ConnectionError
-        if r.text:
-            data = r.json()
-            return data
+        return data
 
     ##### methods for devices #####
 
+    def device_iter(self, query=None, projection=None, page_size=1000, model=False):
+        """Iterate over all devices matching a query, fetching them page by page, as Device objects if model is set"""
+        devices = self.__request_iter("/devices/", query, projection, page_size)
+        if model:
+            return (Device(device) for device in devices)
+        return devices
+
+    def device_count(self, query=None):
+        """Count the devices matching a query without fetching them"""
+        return self.__request_count("/devices/", query)
+
     def device_get_all_IDs(self):
         """Get IDs of all devices"""
-        jsondata = self.__request_get("/devices/" + "?projection=_id")
         data = []
-        for device in jsondata:
+        for device in self.device_iter(projection="_id"):
             data.append(device["_id"])
         return data
 
-    def device_get_by_id(self, device_id):
-        """Get all data of a device identified by its ID"""
-        quoted_id = requests.utils.quote("{\"_id\":\"" + device_id + "\"}", safe = '')
-        return self.__request_get("/devices/" + "?query=" + quoted_id)
+    def device_get_by_id(self, device_id, raw=False):
+        """Get all data of a device identified by its ID, as undecoded JSON bytes if raw is set"""
+        return self.__request_get("/devices/?" + _DEVICE_BY_ID.encode(id=device_id), raw=raw)
 
-    def device_get_by_MAC(self, device_MAC):
-        """Get all data of a device identified by its MAC address"""
-        quoted_MAC = requests.utils.quote("{\"summary.mac\":\"" + device_MAC + "\"}", safe = '')
-        return self.__request_get("/devices/" + "?query=" + quoted_MAC)
+    def device_get_by_MAC(self, device_MAC, raw=False):
+        """Get all data of a device identified by its MAC address, as undecoded JSON bytes if raw is set"""
+        return self.__request_get("/devices/?" + _DEVICE_BY_MAC.encode(mac=device_MAC), raw=raw)
 
-    def device_get_by_serial(self, device_serial):
-        """Get all data of a device identified by its Serial"""
-        quoted_serial = requests.utils.quote("{\"InternetGatewayDevice.DeviceInfo.SerialNumber\":\"" + device_serial + "\"}", safe = '')
-        return self.__request_get("/devices/" + "?query=" + quoted_serial)
+    def device_get_by_serial(self, device_serial, raw=False):
+        """Get all data of a device identified by its Serial, as undecoded JSON bytes if raw is set"""
+        return self.__request_get("/devices/?" + _DEVICE_BY_SERIAL.encode(serial=device_serial), raw=raw)
 
     def device_get_parameter(self, device_id, parameter_name):
         """Directly get the value of a given parameter from a given device"""
-        quoted_id = requests.utils.quote("{\"_id\":\"" + device_id + "\"}", safe = '')
-        data = self.__request_get("/devices" + "?query=" + quoted_id + "&projection=" + parameter_name)
-        try:
-            if parameter_name in ["_tags", "_lastInform", "_registered", "_lastBootstrap", "_lastBoot"]:
-                return data[0][parameter_name]
-            else:
-                value = data[0]
-                for part in parameter_name.split('.'):
-                    value = value[part]
-                return value["_value"]
-        except (IndexError, KeyError):
-            return None
+        data = self.__request_get("/devices?" + _DEVICE_BY_ID.encode(id=device_id), {"projection": parameter_name})
+        return _parameter_value(data, parameter_name)
 
-    def device_get_parameters(self, device_id, parameter_names):
-        """Get a defined list of parameters from a given device"""
-        quoted_id = requests.utils.quote("{\"_id\":\"" + device_id + "\"}", safe = '')
-        data = self.__request_get("/devices" + "?query=" + quoted_id + "&projection=" + parameter_names)
-        try:
-            data = data[0]
-            values = {}
-            src = data
-            dest = values
-        except (IndexError):
-            return {}
-        for parameter in parameter_names.split(','):
-            parameter_parts = parameter.split('.')
-            for part in parameter_parts:
-                if part != parameter_parts[-1]:
-                    try:
-                        src = src[part]
-                    except (KeyError):
-                        src[part] = {}
-                        src = src[part]
-                    if part not in dest.keys():
-                        dest[part] = {}
-                    dest = dest[part]
-                else:
-                    try:
-                        dest[part] = src[part]["_value"]
-                    except (KeyError):
-                        dest[part] = None
-                    dest = values
-                    src = data
-        return values
+    def device_get_parameters(self, device_id, parameter_names, flat=False):
+        """Get a defined list of parameters from a given device, nested or (flat=True) keyed by parameter name"""
+        data = self.__request_get("/devices?" + _DEVICE_BY_ID.encode(id=device_id), {"projection": parameter_names})
+        return _parameter_values(data, parameter_names, flat)
+
+    def __device_get_parameters_chunk(self, device_ids, projection, flat):
+        data = self.__request_get("/devices", {"query": json.dumps({"_id": {"$in": device_ids}}),
+                                               "projection": projection.projection})
+        values = {}
+        for device in data or []:
+            values[device["_id"]] = projection.extract(device, flat)
+        return [(device_id, values.get(device_id, {})) for device_id in device_ids]
+
+    def device_iter_parameters(self, device_ids, parameter_names, chunk_size=100, workers=1, flat=False):
+        """Get a defined list of parameters from many devices, yield (device_id, values) chunk by chunk
+
+        The devices are fetched with one $in query per chunk_size IDs, up to
+        workers chunks at a time. Devices which do not exist get empty values.
+        """
+        projection = _compile_projection(parameter_names)
+        def fetch(chunk):
+            return self.__device_get_parameters_chunk(chunk, projection, flat)
+        for chunk, values in _parallel_map(fetch, _chunks(device_ids, chunk_size), workers):
+            for item in values:
+                yield item
+
+    def device_get_parameters_bulk(self, device_ids, parameter_names, chunk_size=100, workers=1, flat=False):
+        """Get a defined list of parameters from many devices as a dict of values by device ID"""
+        return dict(self.device_iter_parameters(device_ids, parameter_names, chunk_size, workers, flat))
 
     def device_delete(self, device_id):
         """Delete a given device from the database"""
@@ -172,14 +470,24 @@ class Connection(object):
 
     ##### methods for tasks #####
 
-    def task_get_all(self, device_id=None):
+    def task_get_all(self, device_id=None, raw=False, model=False):
         if device_id:
             """Get all existing tasks of a given device"""
-            quoted_id = requests.utils.quote("{\"device\":\"" + device_id + "\"}", safe = '')
-            return self.__request_get("/tasks/" + "?query=" + quoted_id)
+            data = self.__request_get("/tasks/?" + _TASKS_BY_DEVICE.encode(device=device_id), raw=raw)
         else:
             """Get all existing tasks"""
-            return self.__request_get("/tasks/")
+            data = self.__request_get("/tasks/", raw=raw)
+        if model and not raw:
+            return [Task(task) for task in data or []]
+        return data
+
+    def task_iter(self, query=None, projection=None, page_size=1000):
+        """Iterate over all tasks matching a query, fetching them page by page"""
+        return self.__request_iter("/tasks/", query, projection, page_size)
+
+    def task_count(self, query=None):
+        """Count the tasks matching a query without fetching them"""
+        return self.__request_count("/tasks/", query)
 
     def task_refresh_object(self, device_id, object_name, conn_request=True):
         """Create a refreshObject task for a given device"""
@@ -254,12 +562,56 @@ class Connection(object):
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
 
+    def task_create(self, device_id, task, conn_request=True):
+        """Create any task for a given device, return a result dict like task_bulk_iter instead of raising"""
+        url = "/devices/" + requests.utils.quote(device_id) + "/tasks"
+        if conn_request:
+            url += "?connection_request"
+        try:
+            r, data = self.__request("POST", url, decode=True, json=task)
+        except requests.exceptions.Timeout as err:
+            return {"status": "timeout", "task": None, "error": str(err)}
+        except requests.exceptions.RequestException as err:
+            return {"status": "error", "task": None, "error": str(err)}
+        if r.status_code == 200:
+            return {"status": "executed", "task": data, "error": None}
+        elif r.status_code == 202:
+            return {"status": "queued", "task": data, "error": None}
+        elif r.status_code == 404:
+            return {"status": "not_found", "task": None, "error": None}
+        else:
+            return {"status": "error", "task": None, "error": str(r.status_code) + " " + r.reason}
+
+    def task_bulk_iter(self, task, device_ids=None, query=None, conn_request=True, workers=8, rate=None):
+        """Create a task for many devices concurrently, yield (device_id, result) as they finish
+
+        task is the task as posted to the NBI, e.g. {"name": "reboot"}. The
+        devices are given as an iterable of IDs or as a device query. Up to
+        workers requests are in flight at once, rate optionally limits the
+        requests per second (a number or a shared RateLimiter). Each result
+        is a dict with the keys "status" (executed, queued, not_found,
+        timeout or error), "task" (the created task) and "error". The devices
+        of a sorted Query are all read before the first task is created.
+        """
+        if device_ids is None:
+            if query is None:
+                raise InvalidRequestDataError
+            device_ids = _read_ordered(query, (device["_id"] for device in self.device_iter(query, "_id")))
+        if rate is not None and not isinstance(rate, RateLimiter):
+            rate = RateLimiter(rate)
+        def create(device_id):
+            return self.task_create(device_id, task, conn_request)
+        return _parallel_map(create, device_ids, workers, rate)
+
+    def task_bulk(self, task, device_ids=None, query=None, conn_request=True, workers=8, rate=None):
+        """Create a task for many devices concurrently, return a dict of results by device ID"""
+        return dict(self.task_bulk_iter(task, device_ids, query, conn_request, workers, rate))
+
     ##### methods for tags ######
 
     def tag_get_all(self, device_id):
         """Get all existing tags of a given device"""
-        quoted_id = requests.utils.quote("{\"_id\":\"" + device_id + "\"}", safe = '')
-        data = self.__request_get("/devices" + "?query=" + quoted_id + "&projection=_tags")
+        data = self.__request_get_cached("tags", "/devices?" + _DEVICE_TAGS.encode(id=device_id))
         try:
             return data[0]["_tags"]
         except (IndexError, KeyError):
@@ -271,6 +623,8 @@ class Connection(object):
             self.__request_post("/devices/" + requests.utils.quote(device_id) + "/tags/" + tag_name, None, False)
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
+        finally:
+            self.__invalidate("tags")
 
     def tag_remove(self, device_id, tag_name):
         """Remove a tag from a device"""
@@ -278,12 +632,101 @@ class Connection(object):
             self.__request_delete("/devices/" + requests.utils.quote(device_id) + "/tags/" + tag_name)
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
+        finally:
+            self.__invalidate("tags")
+
+    def __tag_apply(self, device_id, assign, remove):
+        result = {"status": "changed", "assigned": [], "removed": [], "error": None}
+        url = "/devices/" + requests.utils.quote(device_id, safe="") + "/tags/"
+        for method, tag, done in [("POST", tag, result["assigned"]) for tag in assign] + \
+                                 [("DELETE", tag, result["removed"]) for tag in remove]:
+            try:
+                r, _ = self.__request(method, url + requests.utils.quote(tag, safe=""))
+            except requests.exceptions.Timeout as err:
+                result.update({"status": "timeout", "error": str(err)})
+                return result
+            except requests.exceptions.RequestException as err:
+                result.update({"status": "error", "error": str(err)})
+                return result
+            if r.status_code == 404:
+                result["status"] = "not_found"
+                return result
+            if not r.ok:
+                result.update({"status": "error", "error": str(r.status_code) + " " + r.reason})
+                return result
+            done.append(tag)
+        return result
+
+    def __tag_plan(self, device_ids, query, assign, remove, chunk_size):
+        # yield (device_id, tags to assign, tags to remove, found) with the
+        # current tags fetched in $in batches, or along with a device query
+        if device_ids is None:
+            for device in _read_ordered(query, self.device_iter(query, "_id,_tags", chunk_size)):
+                tags = device.get("_tags") or []
+                yield (device["_id"], [tag for tag in assign if tag not in tags],
+                       [tag for tag in remove if tag in tags], True)
+            return
+        for chunk in _chunks(device_ids, chunk_size):
+            current = {}
+            for device in self.__request_get("/devices", {"query": json.dumps({"_id": {"$in": chunk}}),
+                                                          "projection": "_tags"}) or []:
+                current[device["_id"]] = device.get("_tags") or []
+            for device_id in chunk:
+                tags = current.get(device_id)
+                if tags is None:
+                    yield device_id, [], [], False
+                else:
+                    yield (device_id, [tag for tag in assign if tag not in tags],
+                           [tag for tag in remove if tag in tags], True)
+
+    def tag_bulk_iter(self, assign=None, remove=None, device_ids=None, query=None, chunk_size=100, workers=8,
+                      rate=None):
+        """Assign and remove tags on many devices concurrently, yield (device_id, result) as they finish
+
+        assign and remove are a tag or a list of tags. The devices are given
+        as an iterable of IDs or as a device query. Their current tags are
+        fetched first, with one $in query per chunk_size IDs, so only the
+        missing tags are assigned and only the present ones removed. Up to
+        workers devices are changed at once, rate optionally limits the
+        devices changed per second (a number or a shared RateLimiter). Each
+        result is a dict with the keys "status" (changed, unchanged,
+        not_found, timeout or error), "assigned" and "removed" (the tags
+        changed) and "error". The devices of a sorted Query are all read
+        before the first change.
+        """
+        if device_ids is None and query is None:
+            raise InvalidRequestDataError
+        if not isinstance(assign, (list, tuple)):
+            assign = [assign] if assign else []
+        if not isinstance(remove, (list, tuple)):
+            remove = [remove] if remove else []
+        if rate is not None and not isinstance(rate, RateLimiter):
+            rate = RateLimiter(rate)
+        def apply(plan):
+            device_id, to_assign, to_remove, found = plan
+            if not found:
+                return {"status": "not_found", "assigned": [], "removed": [], "error": None}
+            if not to_assign and not to_remove:
+                return {"status": "unchanged", "assigned": [], "removed": [], "error": None}
+            if rate is not None:
+                rate.acquire()
+            return self.__tag_apply(device_id, to_assign, to_remove)
+        try:
+            for plan, result in _parallel_map(apply, self.__tag_plan(device_ids, query, assign, remove, chunk_size),
+                                              workers):
+                yield plan[0], result
+        finally:
+            self.__invalidate("tags")
+
+    def tag_bulk(self, assign=None, remove=None, device_ids=None, query=None, chunk_size=100, workers=8, rate=None):
+        """Assign and remove tags on many devices concurrently, return a dict of results by device ID"""
+        return dict(self.tag_bulk_iter(assign, remove, device_ids, query, chunk_size, workers, rate))
 
     ##### methods for presets #####
 
     def preset_get_all(self, filename=None):
         """Get all existing presets as a json object, optionally write them to a file"""
-        data = self.__request_get("/presets")
+        data = self.__request_get_cached("presets", "/presets")
         try:
             if filename is not None:
                 f = open(filename, 'w')
@@ -301,6 +744,8 @@ class Connection(object):
             self.__request_put("/presets/" + quoted_name, data)
         except requests.exceptions.HTTPError:
             raise InvalidRequestDataError
+        finally:
+            self.__invalidate("presets")
 
     def preset_create_all_from_file(self, filename):
         """Create all presets contained in a json file"""
@@ -318,6 +763,8 @@ class Connection(object):
             print("preset_create_all_from_file:\nValueError: File contains faulty values\n")
         except KeyError:
             print("preset_create_all_from_file:\nKeyError: File contains faulty keys\n")
+        finally:
+            self.__invalidate("presets")
 
     def preset_delete(self, preset_name):
         """Delete a given preset"""
@@ -326,12 +773,14 @@ class Connection(object):
             self.__request_delete("/presets/" + quoted_name)
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
+        finally:
+            self.__invalidate("presets")
 
     ##### methods for objects #####
 
     def object_get_all(self, filename=None):
         """Get all existing objects as a json object, optionally write them to a file"""
-        data = self.__request_get("/objects")
+        data = self.__request_get_cached("objects", "/objects")
         try:
             if filename is not None:
                 f = open(filename, 'w')
@@ -349,6 +798,8 @@ class Connection(object):
             self.__request_put("/objects/" + quoted_name, data)
         except requests.exceptions.HTTPError:
             raise InvalidRequestDataError
+        finally:
+            self.__invalidate("objects")
 
     def object_create_all_from_file(self, filename):
         """Create all objects contained in a json file"""
@@ -366,6 +817,8 @@ class Connection(object):
             print("object_create_all_from_file:\nValueError: File contains faulty values\n")
         except KeyError:
             print("object_create_all_from_file:\nKeyError: File contains faulty keys\n")
+        finally:
+            self.__invalidate("objects")
 
     def object_delete(self, object_name):
         """Delete a given object"""
@@ -374,12 +827,14 @@ class Connection(object):
             self.__request_delete("/objects/" + quoted_name)
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
+        finally:
+            self.__invalidate("objects")
 
     ##### methods for provisions #####
 
     def provision_get_all(self, filename=None):
         """Get all existing provisions as a json object, optionally write them to a file"""
-        data = self.__request_get("/provisions")
+        data = self.__request_get_cached("provisions", "/provisions")
         try:
             if filename is not None:
                 f = open(filename, 'w')
@@ -397,6 +852,8 @@ class Connection(object):
             self.__request_put("/provisions/" + quoted_name, data)
         except requests.exceptions.HTTPError:
             raise InvalidRequestDataError
+        finally:
+            self.__invalidate("provisions")
 
     def provision_create_all_from_file(self, filename):
         """Create all provisions contained in a json file"""
@@ -414,6 +871,8 @@ class Connection(object):
             print("provision_create_all_from_file:\nValueError: File contains faulty values\n")
         except KeyError:
             print("provision_create_all_from_file:\nKeyError: File contains faulty keys\n")
+        finally:
+            self.__invalidate("provisions")
 
     def provision_delete(self, provision_name):
         """Delete a given provision"""
@@ -422,68 +881,255 @@ class Connection(object):
             self.__request_delete("/provisions/" + quoted_name)
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
+        finally:
+            self.__invalidate("provisions")
+
+    ##### methods for syncing presets, objects and provisions #####
+
+    def __sync(self, collection, desired, delete, dry_run, workers):
+        if not isinstance(desired, (list, tuple)):
+            with open(desired, 'r') as f:
+                desired = json.load(f)
+        def body(item):
+            if collection == "provisions":
+                return item["script"]
+            content = dict(item)
+            del content["_id"]
+            return content
+        current = {}
+        for item in self.__request_get("/" + collection) or []:
+            current[item["_id"]] = body(item)
+        report = {"created": [], "updated": [], "deleted": [], "unchanged": [], "failed": {}}
+        changes = []
+        wanted = set()
+        for item in desired:
+            name = item["_id"]
+            wanted.add(name)
+            content = body(item)
+            if name not in current:
+                changes.append(("created", name, content))
+            elif current[name] != content:
+                changes.append(("updated", name, content))
+            else:
+                report["unchanged"].append(name)
+        if delete:
+            for name in current:
+                if name not in wanted:
+                    changes.append(("deleted", name, None))
+        if dry_run:
+            for action, name, content in changes:
+                report[action].append(name)
+            return report
+        def apply(change):
+            # returns None or the error as a string, nothing may raise here:
+            # a failed change must not lose the report of the others
+            action, name, content = change
+            url = "/" + collection + "/" + requests.utils.quote(name)
+            try:
+                if action == "deleted":
+                    r, _ = self.__request("DELETE", url)
+                elif collection == "provisions":
+                    r, _ = self.__request("PUT", url, data=content)
+                else:
+                    r, _ = self.__request("PUT", url, data=json.dumps(content))
+            except requests.exceptions.Timeout as err:
+                return "timeout: " + str(err)
+            except requests.exceptions.RequestException as err:
+                return str(err) or type(err).__name__
+            if not r.ok:
+                return str(r.status_code) + " " + r.reason
+        try:
+            for (action, name, content), error in _parallel_map(apply, changes, workers):
+                if error is None:
+                    report[action].append(name)
+                else:
+                    report["failed"][name] = error
+        finally:
+            self.__invalidate(collection)
+        return report
+
+    def preset_sync(self, desired, delete=False, dry_run=False, workers=8):
+        """Make the presets on the server match a list of presets or a json file of them
+
+        Only presets which are missing or differ are written, with delete=True
+        presets not in the list are deleted. Up to workers changes are applied
+        at once. Returns a report with the names of created, updated, deleted
+        and unchanged presets and the error message of each failed change by
+        name, e.g. "400 Bad Request". With dry_run=True nothing is changed and
+        the report lists what would be.
+        """
+        return self.__sync("presets", desired, delete, dry_run, workers)
+
+    def object_sync(self, desired, delete=False, dry_run=False, workers=8):
+        """Make the objects on the server match a list of objects or a json file of them, see preset_sync"""
+        return self.__sync("objects", desired, delete, dry_run, workers)
+
+    def provision_sync(self, desired, delete=False, dry_run=False, workers=8):
+        """Make the provisions on the server match a list of provisions or a json file of them, see preset_sync"""
+        return self.__sync("provisions", desired, delete, dry_run, workers)
+
+    def config_sync(self, presets=None, objects=None, provisions=None, delete=False, dry_run=False, workers=8):
+        """Sync presets, objects and provisions at once, return the reports by kind"""
+        report = {}
+        if objects is not None:
+            report["objects"] = self.object_sync(objects, delete, dry_run, workers)
+        if provisions is not None:
+            report["provisions"] = self.provision_sync(provisions, delete, dry_run, workers)
+        if presets is not None:
+            report["presets"] = self.preset_sync(presets, delete, dry_run, workers)
+        return report
 
     ##### methods for files #####
 
-    def file_upload(self, filename, fileType, oui, productClass, version):
-        """Upload or update a file"""
+    def file_upload(self, filename, fileType, oui, productClass, version, progress=None, md5=None):
+        """Upload or update a file, streaming it from disk
+
+        progress is called with the number of bytes sent and the file size
+        while uploading. If md5 is given it is compared with the checksum of
+        the sent data; on a mismatch the uploaded file is deleted again and
+        InvalidRequestDataError is raised. Returns the MD5 of the sent data.
+        """
         try:
-            self.__request_put("/files/" + filename, data=open(filename, "rb"), headers={"fileType": fileType, "oui": oui, "productClass": productClass, "version" : version})
+            with open(filename, "rb") as f:
+                reader = _UploadReader(f, progress)
+                self.__request_put("/files/" + filename, data=reader, headers={"fileType": fileType, "oui": oui, "productClass": productClass, "version" : version})
+            checksum = reader.md5.hexdigest()
+            if md5 is not None and md5.lower() != checksum:
+                self.__request_delete("/files/" + filename)
+                raise InvalidRequestDataError
+            return checksum
         except IOError as err:
             print("file_upload:\nIOError: " + str(err) + "\n")
+        finally:
+            self.__invalidate("files")
+
+    def file_upload_all(self, files, workers=4, progress=None):
+        """Upload several files concurrently
+
+        files is an iterable of (filename, fileType, oui, productClass,
+        version) tuples. progress is called with the filename, the bytes
+        sent and the file size. Returns a dict with the MD5 of every
+        uploaded file, or the exception its upload raised.
+        """
+        def upload(item):
+            file_progress = None
+            if progress is not None:
+                file_progress = functools.partial(progress, item[0])
+            try:
+                return self.file_upload(*item, progress=file_progress)
+            except Exception as err:
+                return err
+        results = {}
+        for item, result in _parallel_map(upload, files, workers):
+            results[item[0]] = result
+        return results
+
+    def file_download(self, filename, destination, progress=None, chunk_size=65536):
+        """Download a file to a path or a writable file object without buffering it in memory
+
+        progress is called with the bytes received and the file size (None
+        if the server did not send a Content-Length). Returns the number of
+        bytes written.
+        """
+        try:
+            r, _ = self.__request("GET", "/files/" + requests.utils.quote(filename), stream=True)
+        except requests.exceptions.ConnectionError:
+            raise ConnectionError
+        with r:
+            if r.status_code == 404:
+                raise ItemNotFoundError
+            try:
+                r.raise_for_status()
+            except requests.exceptions.HTTPError:
+                raise ConnectionError
+            total = r.headers.get("Content-Length")
+            if total is not None:
+                total = int(total)
+            received = 0
+            if hasattr(destination, "write"):
+                f = destination
+            else:
+                f = open(destination, "wb")
+            try:
+                for chunk in r.iter_content(chunk_size):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress(received, total)
+            finally:
+                if f is not destination:
+                    f.close()
+        return received
+
+    def file_download_all(self, filenames, directory, workers=4, progress=None):
+        """Download several files concurrently into a directory
+
+        progress is called with the filename, the bytes received and the file
+        size. Returns a dict with the number of bytes written for every file,
+        or the exception its download raised.
+        """
+        def download(filename):
+            file_progress = None
+            if progress is not None:
+                file_progress = functools.partial(progress, filename)
+            try:
+                return self.file_download(filename, os.path.join(directory, filename), file_progress)
+            except Exception as err:
+                return err
+        return dict(_parallel_map(download, filenames, workers))
 
     def file_delete(self, filename):
         """Delete a given file"""
-        self.__request_delete("/files/" + filename)
+        try:
+            self.__request_delete("/files/" + filename)
+        finally:
+            self.__invalidate("files")
 
     def file_get_all(self):
         """Get all files as a json object"""
-        return self.__request_get("/files")
+        return self.__request_get_cached("files", "/files")
 
     def file_get(self, filename=None, fileType=None, oui=None, productClass=None, version=None):
         """Get all data from one or several files"""
-        url = "{"
+        query = Query()
         if filename is not None:
-            url += "\"filename\":\"" + filename + "\""
+            query = query.where("filename", filename)
         else:
-            if fileType is not None:
-                if url != "{":
-                    url += ","
-                url += "\"metadata.fileType\":\"" + fileType + "\""
-            if oui is not None:
-                if url != "{":
-                    url += ","
-                url += "\"metadata.oui\":\"" + oui + "\""
-            if productClass is not None:
-                if url != "{":
-                    url += ","
-                url += "\"metadata.productClass\":\"" + productClass + "\""
-            if version is not None:
-                if url != "{":
-                    url += ","
-                url += "\"metadata.version\":\"" + version + "\""
-        if url == "{":
+            for field, value in (("metadata.fileType", fileType), ("metadata.oui", oui),
+                                 ("metadata.productClass", productClass), ("metadata.version", version)):
+                if value is not None:
+                    query = query.where(field, value)
+        if not query.conditions:
             raise InvalidRequestDataError
-        return self.__request_get("/files/?query=" + requests.utils.quote(url + "}", safe = ''))
+        return self.__request_get_cached("files", "/files/?" + query.encode())
 
     ##### methods for faults #####
 
+    def fault_iter(self, query=None, projection=None, page_size=1000, model=False):
+        """Iterate over all faults matching a query, fetching them page by page, as Fault objects if model is set"""
+        faults = self.__request_iter("/faults/", query, projection, page_size)
+        if model:
+            return (Fault(fault) for fault in faults)
+        return faults
+
+    def fault_count(self, query=None):
+        """Count the faults matching a query without fetching them"""
+        return self.__request_count("/faults/", query)
+
     def fault_get_all_IDs(self):
         """Get IDs of all faults"""
-        jsondata = self.__request_get("/faults/" + "?projection=_id")
         data = []
-        for fault in jsondata:
+        for fault in self.fault_iter(projection="_id"):
             data.append(fault["_id"])
         return data
 
     def fault_get_all(self, device_id=None):
         if device_id:
             """Get all existing faults for a given device"""
-            quoted_id = requests.utils.quote("{\"device\":\"" + device_id + "\"}", safe = '')
-            return self.__request_get("/faults/" + "?query=" + quoted_id)
+            return list(self.fault_iter({"device": device_id}))
         else:
             """Get all existing faults"""
-            return self.__request_get("/faults/")
+            return list(self.fault_iter())
 
     def fault_delete(self, fault_id):
         """Delete a given fault"""
@@ -493,6 +1139,1767 @@ class Connection(object):
         except requests.exceptions.HTTPError:
             raise ItemNotFoundError
 
+    def __fault_filter(self, query, code, channel, device, older_than):
+        if isinstance(query, Query):
+            filters = _fault_query(None, code, channel, device, older_than)
+            return query.where(filters) if filters else query
+        return _fault_query(query, code, channel, device, older_than)
+
+    def fault_find(self, query=None, code=None, channel=None, device=None, older_than=None, projection=None,
+                   page_size=1000, model=False):
+        """Iterate over the faults matching a query and the given filters
+
+        code, channel and device are a single value or a list of values,
+        older_than only matches faults older than a number of seconds or a
+        UTC datetime.
+        """
+        return self.fault_iter(self.__fault_filter(query, code, channel, device, older_than), projection, page_size,
+                               model)
+
+    def fault_summary(self, query=None, code=None, channel=None, device=None, older_than=None):
+        """Count the faults matching a query and the given filters by fault code"""
+        return self.fault_group_by("code", self.__fault_filter(query, code, channel, device, older_than))
+
+    def __fault_triage_result(self, fault, action):
+        channel = fault.get("channel") or ""
+        if action == "retry" and channel.startswith("task_"):
+            method, url = "POST", "/tasks/" + requests.utils.quote(channel[5:]) + "/retry"
+        else:
+            # a fault outside a task channel is retried by deleting it
+            method, url = "DELETE", "/faults/" + requests.utils.quote(fault["_id"])
+        try:
+            r, _ = self.__request(method, url)
+        except requests.exceptions.Timeout as err:
+            return {"status": "timeout", "error": str(err)}
+        except requests.exceptions.RequestException as err:
+            return {"status": "error", "error": str(err)}
+        if r.ok:
+            return {"status": "retried" if action == "retry" else "deleted", "error": None}
+        elif r.status_code == 404:
+            return {"status": "not_found", "error": None}
+        else:
+            return {"status": "error", "error": str(r.status_code) + " " + r.reason}
+
+    def fault_bulk_iter(self, action, query=None, code=None, channel=None, device=None, older_than=None, workers=8,
+                        rate=None):
+        """Retry or delete all faults matching a query and filters concurrently, yield (fault, result) as they finish
+
+        action is "retry" or "delete". Faults of a task are retried through
+        the task, all others by deleting the fault so their channel runs
+        again at the next inform. The faults are streamed page by page (all
+        read first for a sorted Query), up to workers requests are in flight at once and rate optionally limits
+        the requests per second (a number or a shared RateLimiter). Each
+        result is a dict with the keys "status" (retried, deleted,
+        not_found, timeout or error) and "error".
+        """
+        if action not in ("retry", "delete"):
+            raise InvalidRequestDataError
+        if rate is not None and not isinstance(rate, RateLimiter):
+            rate = RateLimiter(rate)
+        faults = _read_ordered(query, self.fault_find(query, code, channel, device, older_than,
+                                                      "_id,channel,code,device"))
+        def triage(fault):
+            return self.__fault_triage_result(fault, action)
+        return _parallel_map(triage, faults, workers, rate)
+
+    def fault_bulk(self, action, query=None, code=None, channel=None, device=None, older_than=None, workers=8,
+                   rate=None):
+        """Retry or delete all faults matching a query and filters concurrently, return a summary
+
+        The summary holds the number of faults handled ("total"), the
+        number of faults by status ("by_status") and by fault code and
+        status ("by_code") and the errors of failed faults by fault ID
+        ("failed"), see fault_bulk_iter.
+        """
+        summary = {"total": 0, "by_status": {}, "by_code": {}, "failed": {}}
+        for fault, result in self.fault_bulk_iter(action, query, code, channel, device, older_than, workers, rate):
+            status = result["status"]
+            summary["total"] += 1
+            summary["by_status"][status] = summary["by_status"].get(status, 0) + 1
+            by_code = summary["by_code"].setdefault(fault.get("code"), {})
+            by_code[status] = by_code.get(status, 0) + 1
+            if result["error"] is not None:
+                summary["failed"][fault["_id"]] = result["error"]
+        return summary
+
+    ##### methods for statistics #####
+
+    def __count_all(self, url, queries, workers):
+        if isinstance(queries, dict):
+            queries = queries.items()
+        def count(item):
+            return self.__request_count(url, item[1])
+        return dict((name, total) for (name, query), total in _parallel_map(count, queries, workers))
+
+    def __group_by(self, url, field, query, page_size):
+        # only the grouped field is fetched and only the counters are kept
+        projection = _compile_projection(field)
+        counts = {}
+        for document in self.__request_iter(url, query, projection.projection, page_size):
+            value = projection.extract(document, flat=True)[field]
+            for item in (value if isinstance(value, list) else [value]):
+                counts[item] = counts.get(item, 0) + 1
+        return counts
+
+    def device_count_all(self, queries, workers=4):
+        """Count the devices of several queries, given as a dict of queries by name, return the counts by name"""
+        return self.__count_all("/devices/", queries, workers)
+
+    def device_group_by(self, parameter_name, query=None, values=None, workers=4, page_size=1000):
+        """Count the devices matching a query by the value of a parameter or attribute
+
+        Without values the devices are fetched page by page projected to the
+        parameter alone and counted as they stream in, list attributes like
+        _tags count every item. With a list of the expected values only one
+        count request per value is sent and no devices are downloaded.
+        """
+        if values is None:
+            return self.__group_by("/devices/", parameter_name, query, page_size)
+        if parameter_name not in ("_id", "_tags", "_lastInform", "_registered", "_lastBoot", "_lastBootstrap") and \
+                not parameter_name.startswith("_deviceId."):
+            field = parameter_name + "._value"
+        else:
+            field = parameter_name
+        base = query if isinstance(query, Query) else Query(query)
+        return self.device_count_all([(value, base.where(field, value)) for value in values], workers)
+
+    def device_inform_ages(self, buckets=(300, 3600, 86400, 7 * 86400), query=None, workers=4):
+        """Histogram of the time since the last inform of the devices matching a query
+
+        buckets are the upper bounds of the age classes in seconds. Returns
+        a list of (upper bound, number of devices) with the devices older
+        than the last bound, or which never informed, counted under None.
+        Only len(buckets) + 1 count requests are sent.
+        """
+        base = query if isinstance(query, Query) else Query(query)
+        buckets = sorted(buckets)
+        now = datetime.datetime.utcnow()
+        queries = [(bound, base.informed_since(now - datetime.timedelta(seconds=bound))) for bound in buckets]
+        counts = self.device_count_all(queries + [(None, base)], workers)
+        histogram = []
+        previous = 0
+        for bound in buckets + [None]:
+            histogram.append((bound, counts[bound] - previous))
+            previous = counts[bound]
+        return histogram
+
+    def task_group_by(self, field="name", query=None, page_size=1000):
+        """Count the tasks matching a query by a field, by default their name"""
+        return self.__group_by("/tasks/", field, query, page_size)
+
+    def fault_group_by(self, field="code", query=None, page_size=1000):
+        """Count the faults matching a query by a field, by default their code"""
+        return self.__group_by("/faults/", field, query, page_size)
+
+class _ClusterNode(object):
+    __slots__ = ("base_url", "failures", "open_until", "latency", "inflight", "requests", "errors")
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.failures = 0
+        self.open_until = 0
+        self.latency = 0.0
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+
+def _not_sent(err):
+    # True if a request failed before it reached the server, so sending it
+    # again can not apply it twice
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], "reason", None) if err.args else None
+    return isinstance(reason, NewConnectionError)
+
+class ClusterConnection(Connection):
+    """Connection spreading its requests over several NBI nodes of one GenieACS cluster.
+
+    endpoints lists the nodes as "host", "host:port" or (host, port), all
+    other arguments are those of Connection. strategy "round_robin" takes
+    the nodes in turn, "least_latency" the node with the lowest average
+    latency weighted by its requests in flight.
+
+    A node failing failure_threshold requests in a row (connection errors,
+    timeouts, broken responses, 502, 503 and 504) is skipped for recovery_time
+    seconds, then a single trial request decides whether it is used again.
+    Idempotent requests (GET, HEAD, PUT, DELETE) which fail are retried on
+    the other nodes, POSTs only if they never reached the failed node. With
+    health_interval set every node is probed with a cheap device query in
+    a background thread that often, check_health() probes them once.
+    """
+    def __init__(self, endpoints, strategy="round_robin", failure_threshold=3, recovery_time=30,
+                 health_interval=None, **kwargs):
+        if strategy not in ("round_robin", "least_latency"):
+            raise InvalidRequestDataError
+        scheme = "https://" if kwargs.get("ssl") else "http://"
+        default_port = kwargs.pop("port", 7557)
+        self.nodes = []
+        hosts = []
+        for endpoint in endpoints:
+            if isinstance(endpoint, (list, tuple)):
+                host, port = endpoint
+            elif ":" in endpoint:
+                host, port = endpoint.rsplit(":", 1)
+            else:
+                host, port = endpoint, default_port
+            hosts.append((host, port))
+            self.nodes.append(_ClusterNode(scheme + host + ":" + str(port) + kwargs.get("url", "")))
+        if not self.nodes:
+            raise InvalidRequestDataError
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.cluster_lock = threading.Lock()
+        self.next_node = 0
+        self.health_stop = threading.Event()
+        self.health_thread = None
+        Connection.__init__(self, hosts[0][0], hosts[0][1], **kwargs)
+        if health_interval:
+            self.health_thread = threading.Thread(target=self.__health_loop, args=(health_interval,),
+                                                  name="ClusterConnection health")
+            self.health_thread.daemon = True
+            self.health_thread.start()
+
+    def __select(self, tried):
+        now = time.time()
+        with self.cluster_lock:
+            untried = [node for node in self.nodes if node not in tried]
+            candidates = [node for node in untried if node.open_until <= now]
+            if not candidates:
+                # every node is failing, try the one which failed first
+                node = min(untried, key=lambda node: node.open_until)
+            elif self.strategy == "least_latency":
+                node = min(candidates, key=lambda node: node.latency * (node.inflight + 1))
+            else:
+                self.next_node += 1
+                node = candidates[self.next_node % len(candidates)]
+            if node.failures >= self.failure_threshold:
+                # trial request, keep the others away until it is answered
+                node.open_until = now + self.recovery_time
+            node.inflight += 1
+        return node
+
+    def __finish(self, node, latency):
+        # latency is None for a failed request
+        with self.cluster_lock:
+            node.inflight -= 1
+            node.requests += 1
+            if latency is None:
+                node.errors += 1
+                node.failures += 1
+                if node.failures >= self.failure_threshold:
+                    node.open_until = time.time() + self.recovery_time
+            else:
+                node.failures = 0
+                node.open_until = 0
+                node.latency = latency if not node.latency else node.latency * 0.8 + latency * 0.2
+
+    def _send(self, method, url, **kwargs):
+        # streamed uploads can not be sent a second time
+        idempotent = method in ("GET", "HEAD", "PUT", "DELETE") and not hasattr(kwargs.get("data"), "read")
+        tried = []
+        while True:
+            node = self.__select(tried)
+            tried.append(node)
+            last = len(tried) == len(self.nodes)
+            started = time.time()
+            # latency stays None unless the node answered, __finish must
+            # run for every request or inflight is never decremented
+            latency = None
+            try:
+                r = self.session.request(method, node.base_url + url, timeout=self.timeout, **kwargs)
+                if r.status_code not in (502, 503, 504):
+                    latency = time.time() - started
+            except requests.exceptions.RequestException as err:
+                # connection errors, timeouts and bodies cut short by a
+                # dying node (ChunkedEncodingError) alike
+                if last or not (idempotent or _not_sent(err)):
+                    raise
+                continue
+            finally:
+                self.__finish(node, latency)
+            if latency is None and idempotent and not last:
+                r.close()
+                continue
+            return r
+
+    def check_health(self):
+        """Probe every node with a cheap device query, return a dict of node URL -> healthy"""
+        health = {}
+        for node in self.nodes:
+            try:
+                r = self.session.get(node.base_url + "/devices/", params=_PING_PARAMS, timeout=self.timeout)
+                healthy = r.ok
+            except requests.exceptions.RequestException:
+                healthy = False
+            with self.cluster_lock:
+                if healthy:
+                    node.failures = 0
+                    node.open_until = 0
+                else:
+                    node.failures = max(node.failures + 1, self.failure_threshold)
+                    node.open_until = time.time() + self.recovery_time
+            health[node.base_url] = healthy
+        return health
+
+    def __health_loop(self, interval):
+        while not self.health_stop.wait(interval):
+            self.check_health()
+
+    def node_status(self):
+        """Get the state of every node: URL, healthy, latency (average seconds), inflight, requests and errors"""
+        now = time.time()
+        with self.cluster_lock:
+            return [{"url": node.base_url, "healthy": node.open_until <= now and node.failures < self.failure_threshold,
+                     "latency": node.latency, "inflight": node.inflight, "requests": node.requests,
+                     "errors": node.errors} for node in self.nodes]
+
+    def close(self):
+        """Stop the health checks"""
+        self.health_stop.set()
+        if self.health_thread is not None:
+            self.health_thread.join()
+            self.health_thread = None
+
+def _timestamp(moment):
+    # moment is a UTC datetime or a number of seconds ago
+    if not isinstance(moment, datetime.datetime):
+        moment = datetime.datetime.utcnow() - datetime.timedelta(seconds=moment)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def _timestamp_before(timestamp, seconds):
+    # a timestamp of the NBI moved seconds back, the fraction is dropped
+    # which only moves it back a little further
+    moment = datetime.datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+    return _timestamp(moment - datetime.timedelta(seconds=seconds))
+
+class Param(object):
+    """Placeholder for a value of a Query which is filled in when the query is encoded"""
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Param(%r)" % self.name
+
+def _param_json(value):
+    if isinstance(value, Param):
+        return "\x00" + value.name + "\x00"
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+def _quote_json(value):
+    # quote() is much faster for strings without characters to escape,
+    # so the quotes around a JSON string are added already escaped
+    serialized = json.dumps(value)
+    if serialized.startswith('"'):
+        return "%22" + requests.utils.quote(serialized[1:-1], safe="") + "%22"
+    return requests.utils.quote(serialized, safe="")
+
+def _bind(value, values):
+    if isinstance(value, Param):
+        try:
+            return values[value.name]
+        except KeyError:
+            raise InvalidRequestDataError
+    if isinstance(value, dict):
+        return dict((key, _bind(item, values)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_bind(item, values) for item in value]
+    return value
+
+class _SecondsAgo(object):
+    # a time relative to when the query is used, see Query.informed_since
+    __slots__ = ("seconds",)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "_SecondsAgo(%r)" % self.seconds
+
+def _resolve_times(value):
+    if isinstance(value, _SecondsAgo):
+        return _timestamp(value.seconds)
+    if isinstance(value, dict):
+        return dict((key, _resolve_times(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_resolve_times(item) for item in value]
+    return value
+
+class Query(object):
+    """MongoDB style query for the read methods of the NBI, with projection, limit and sort.
+
+    The builder methods return a new Query and leave the original as it
+    is, so queries can be kept in constants and extended per call:
+
+        active = Query().product_class("r4500").informed_since(3600).select("_id", "_tags")
+        for device in acs.device_iter(active.tag("staged").limit(100)):
+
+    The serialized and URL-encoded form is computed once per Query, unless
+    it holds a number of seconds passed to informed_since or
+    informed_before: those count back from each use of the query, which is
+    then encoded every time. Values may be Param placeholders, encode()
+    then only serializes the values passed for them, bind() returns a
+    Query with the values filled in. device_iter, task_iter, fault_iter, fault_find and the bulk methods
+    taking a device query accept a Query, so do device_count, task_count
+    and fault_count.
+    """
+    def __init__(self, query=None):
+        if query is not None and not isinstance(query, dict):
+            query = json.loads(query)
+        self.conditions = (query,) if query else ()
+        self.projection = None
+        self.max_items = None
+        self.order = ()
+        # True if a condition holds a _SecondsAgo
+        self.relative = False
+        self.encoded = None
+
+    def __copy(self, condition=None):
+        query = Query()
+        query.conditions = self.conditions + ((condition,) if condition else ())
+        query.projection = self.projection
+        query.max_items = self.max_items
+        query.order = self.order
+        query.relative = self.relative
+        return query
+
+    def where(self, field, value=None):
+        """Match documents whose field equals value, or all conditions of a query dict"""
+        if isinstance(field, dict):
+            return self.__copy(field)
+        return self.__copy({field: value})
+
+    def is_in(self, field, values):
+        return self.__copy({field: {"$in": list(values)}})
+
+    def ne(self, field, value):
+        return self.__copy({field: {"$ne": value}})
+
+    def gt(self, field, value):
+        return self.__copy({field: {"$gt": value}})
+
+    def gte(self, field, value):
+        return self.__copy({field: {"$gte": value}})
+
+    def lt(self, field, value):
+        return self.__copy({field: {"$lt": value}})
+
+    def lte(self, field, value):
+        return self.__copy({field: {"$lte": value}})
+
+    def exists(self, field, exists=True):
+        return self.__copy({field: {"$exists": exists}})
+
+    def ids(self, device_ids):
+        """Match the documents with one of the given IDs"""
+        return self.is_in("_id", device_ids)
+
+    def tag(self, tag):
+        """Match devices with a tag"""
+        return self.where("_tags", tag)
+
+    def product_class(self, product_class):
+        """Match devices of a product class"""
+        return self.where("_deviceId._ProductClass", product_class)
+
+    def __moment(self, operator, moment):
+        if isinstance(moment, datetime.datetime):
+            return self.__copy({"_lastInform": {operator: _timestamp(moment)}})
+        query = self.__copy({"_lastInform": {operator: _SecondsAgo(moment)}})
+        query.relative = True
+        return query
+
+    def informed_since(self, moment):
+        """Match devices which informed after a UTC datetime or in the last number of seconds before each use"""
+        return self.__moment("$gt", moment)
+
+    def informed_before(self, moment):
+        """Match devices which did not inform since a UTC datetime or for a number of seconds before each use"""
+        return self.__moment("$lt", moment)
+
+    def select(self, *fields):
+        """Fetch only the given fields (projection)"""
+        query = self.__copy()
+        if len(fields) == 1 and isinstance(fields[0], (list, tuple)):
+            fields = fields[0]
+        query.projection = ",".join(fields)
+        return query
+
+    def limit(self, count):
+        """Fetch at most count documents"""
+        query = self.__copy()
+        query.max_items = count
+        return query
+
+    def sort(self, field, direction=1):
+        """Order by field, 1 ascending or -1 descending, calls add further sort fields"""
+        query = self.__copy()
+        query.order = self.order + ((field, direction),)
+        return query
+
+    @property
+    def filter(self):
+        """The query as a dict, conditions on the same field are merged where possible"""
+        conditions = self.conditions
+        if self.relative:
+            conditions = tuple(_resolve_times(condition) for condition in conditions)
+        merged = {}
+        for condition in conditions:
+            for key, value in condition.items():
+                if key not in merged:
+                    merged[key] = value
+                elif isinstance(merged[key], dict) and isinstance(value, dict) and \
+                        not set(merged[key]) & set(value) and not key.startswith("$"):
+                    merged[key] = dict(merged[key], **value)
+                else:
+                    return {"$and": list(conditions)}
+        return merged
+
+    def bind(self, **values):
+        """Return a Query with the Param placeholders replaced by values"""
+        query = self.__copy()
+        query.conditions = tuple(_bind(condition, values) for condition in self.conditions)
+        return query
+
+    def encode(self, **values):
+        """URL-encoded query string of the query, projection, limit and sort with the Params set to values"""
+        encoded = self.encoded
+        if encoded is None:
+            fragments = []
+            names = []
+            condition = self.filter
+            if condition:
+                serialized = json.dumps(condition, separators=(",", ":"), default=_param_json)
+                parts = re.split(r'"\\u0000(.+?)\\u0000"', serialized)
+                fragments = [requests.utils.quote(part, safe="") for part in parts[0::2]]
+                names = parts[1::2]
+            options = ""
+            if self.projection:
+                options += "&projection=" + requests.utils.quote(self.projection, safe=",")
+            if self.order:
+                sort = OrderedDict(self.order)
+                options += "&sort=" + requests.utils.quote(json.dumps(sort, separators=(",", ":")), safe="")
+            if self.max_items is not None:
+                options += "&limit=" + str(self.max_items)
+            encoded = (fragments, names, options)
+            if not self.relative:
+                self.encoded = encoded
+        fragments, names, options = encoded
+        if not fragments:
+            return options[1:]
+        pieces = ["query=", fragments[0]]
+        for name, fragment in zip(names, fragments[1:]):
+            if name not in values:
+                raise InvalidRequestDataError
+            pieces.append(_quote_json(values[name]))
+            pieces.append(fragment)
+        return "".join(pieces) + options
+
+    def __repr__(self):
+        return "Query(%r)" % (self.filter,)
+
+_DEVICE_BY_ID = Query().where("_id", Param("id"))
+_DEVICE_BY_MAC = Query().where("summary.mac", Param("mac"))
+_DEVICE_BY_SERIAL = Query().where("InternetGatewayDevice.DeviceInfo.SerialNumber", Param("serial"))
+_DEVICE_TAGS = _DEVICE_BY_ID.select("_tags")
+_TASKS_BY_DEVICE = Query().where("device", Param("device"))
+
+def _fault_query(query, code, channel, device, older_than):
+    # combine a fault query with the filters of fault_find
+    conditions = []
+    if query:
+        conditions.append(json.loads(query) if not isinstance(query, dict) else query)
+    for field, value in (("code", code), ("channel", channel), ("device", device)):
+        if isinstance(value, (list, tuple, set)):
+            conditions.append({field: {"$in": list(value)}})
+        elif value is not None:
+            conditions.append({field: value})
+    if older_than is not None:
+        conditions.append({"timestamp": {"$lt": _timestamp(older_than)}})
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+def _parameter_value(data, parameter_name):
+    # data is the list returned by a projected device query
+    try:
+        if parameter_name in ["_tags", "_lastInform", "_registered", "_lastBootstrap", "_lastBoot"]:
+            return data[0][parameter_name]
+        else:
+            value = data[0]
+            for part in parameter_name.split('.'):
+                value = value[part]
+            return value["_value"]
+    except (IndexError, KeyError):
+        return None
+
+def _parameter_values(data, parameter_names, flat=False):
+    # data is the list returned by a projected device query
+    try:
+        device = data[0]
+    except (IndexError):
+        return {}
+    return _compile_projection(parameter_names).extract(device, flat)
+
+_projection_cache = {}
+
+def _compile_projection(parameter_names):
+    # remember the projections of the last calls, callers tend to repeat them
+    if isinstance(parameter_names, ParameterProjection):
+        return parameter_names
+    if isinstance(parameter_names, (list, tuple)):
+        parameter_names = ",".join(parameter_names)
+    projection = _projection_cache.get(parameter_names)
+    if projection is None:
+        if len(_projection_cache) >= 128:
+            _projection_cache.clear()
+        projection = _projection_cache[parameter_names] = ParameterProjection(parameter_names)
+    return projection
+
+class ParameterProjection(object):
+    """Precompiled list of parameters to extract from device documents.
+
+    The dotted parameter names are parsed once into a tree, extract() then
+    walks a device document a single time and collects the "_value" (and
+    optionally "_timestamp") of every parameter without modifying the
+    document. Attributes like _tags or _lastInform are returned as they are,
+    missing parameters as None.
+    """
+    def __init__(self, parameter_names):
+        if not isinstance(parameter_names, (list, tuple)):
+            parameter_names = parameter_names.split(',')
+        self.parameter_names = [name for name in parameter_names if name]
+        self.projection = ",".join(self.parameter_names)
+        # every node maps a path part to [child node, full name if it is a parameter]
+        self.tree = {}
+        for name in self.parameter_names:
+            node = self.tree
+            parts = name.split('.')
+            for part in parts[:-1]:
+                node = node.setdefault(part, [{}, None])[0]
+            node.setdefault(parts[-1], [{}, None])[1] = name
+
+    def extract(self, device, flat=False, timestamps=False):
+        """Extract the parameters from a device document
+
+        By default the values are nested like the document itself, with
+        flat=True they are keyed by the full parameter name instead. With
+        timestamps=True every value is a (value, timestamp) tuple.
+        """
+        values = {}
+        _extract(device, self.tree, values, flat, timestamps)
+        return values
+
+def _extract(src, node, dest, flat, timestamps):
+    for part, (children, name) in node.items():
+        if isinstance(src, dict):
+            child = src.get(part)
+        else:
+            child = None
+        if children:
+            if flat:
+                _extract(child, children, dest, flat, timestamps)
+            else:
+                sub = dest.get(part)
+                if sub is None:
+                    sub = dest[part] = {}
+                _extract(child, children, sub, flat, timestamps)
+        if name is not None and (flat or not children):
+            if isinstance(child, dict):
+                value = child.get("_value")
+                if timestamps:
+                    value = (value, child.get("_timestamp"))
+            else:
+                value = child
+                if timestamps:
+                    value = (value, None)
+            if flat:
+                dest[name] = value
+            else:
+                dest[part] = value
+
+class Parameter(object):
+    """A parameter of a device with its value, type, timestamp and writable flag"""
+    __slots__ = ("name", "value", "type", "timestamp", "writable")
+
+    def __init__(self, name, node):
+        self.name = name
+        self.value = node.get("_value")
+        self.type = node.get("_type")
+        self.timestamp = node.get("_timestamp")
+        self.writable = node.get("_writable")
+
+    def __repr__(self):
+        return "Parameter(%r, %r)" % (self.name, self.value)
+
+def _is_parameter(node):
+    # parameters are the leaves of a device document, objects have children
+    # or are marked with _object
+    if not isinstance(node, dict) or node.get("_object"):
+        return False
+    for key in node:
+        if not key.startswith("_"):
+            return False
+    return True
+
+def _find_parameters(node, name, parts):
+    if not isinstance(node, dict):
+        return
+    if not parts:
+        if _is_parameter(node):
+            yield Parameter(name, node)
+            return
+        parts = ["*"]
+        recurse = True
+    else:
+        recurse = False
+    if parts[0] == "*":
+        keys = [key for key in node if not key.startswith("_")]
+    elif parts[0] in node:
+        keys = [parts[0]]
+    else:
+        return
+    for key in keys:
+        for parameter in _find_parameters(node[key], name + "." + key, [] if recurse else parts[1:]):
+            yield parameter
+
+class Device(object):
+    """Compact read-only view of a device document.
+
+    The attributes of the document like _tags or _lastInform are kept as
+    they are. Of every tree below them (InternetGatewayDevice, Device,
+    _deviceId, ...) each object on the second level (DeviceInfo, WANDevice,
+    ...) is kept as compact JSON bytes, which are decoded when a parameter
+    in it is accessed and dropped again afterwards. A list of Devices
+    therefore takes a fraction of the memory of the decoded documents, also
+    after parameters were read. Parameters are looked
+    up by dotted path with get() and value(), find() iterates over all
+    parameters matching a path in which * stands for every instance.
+    """
+    __slots__ = ("id", "_attributes", "_trees")
+
+    def __init__(self, document):
+        self.id = document.get("_id")
+        self._attributes = {}
+        self._trees = {}
+        for key, value in document.items():
+            if isinstance(value, dict):
+                # decoded JSON holds no bytes, so bytes mark the encoded objects
+                self._trees[key] = dict((child, _json_dumps(node) if isinstance(node, dict) else node)
+                                        for child, node in value.items())
+            elif isinstance(value, list):
+                self._attributes[key] = tuple(value)
+            else:
+                self._attributes[key] = value
+
+    @property
+    def tags(self):
+        return list(self._attributes.get("_tags", ()))
+
+    @property
+    def last_inform(self):
+        return self._attributes.get("_lastInform")
+
+    @property
+    def last_boot(self):
+        return self._attributes.get("_lastBoot")
+
+    @property
+    def registered(self):
+        return self._attributes.get("_registered")
+
+    def __tree(self, key, only=None):
+        # decode a tree, with only set just that one of its objects
+        tree = self._trees.get(key)
+        if tree is None:
+            return None
+        return dict((child, _json_loads(node) if isinstance(node, bytes) else node)
+                    for child, node in tree.items()
+                    if only is None or child == only or not isinstance(node, bytes))
+
+    def __node(self, path):
+        parts = path.split(".")
+        node = self.__tree(parts[0], parts[1] if len(parts) > 1 else None)
+        for part in parts[1:]:
+            if not isinstance(node, dict):
+                return None
+            node = node.get(part)
+        return node
+
+    def get(self, path):
+        """Get the Parameter at a dotted path, None if the device has no such parameter"""
+        node = self.__node(path)
+        if _is_parameter(node):
+            return Parameter(path, node)
+        return None
+
+    def __getitem__(self, path):
+        parameter = self.get(path)
+        if parameter is None:
+            raise KeyError(path)
+        return parameter
+
+    def value(self, path, default=None):
+        """Get the value of a parameter or attribute (_tags, _deviceId._OUI, ...) at a dotted path"""
+        if path in self._attributes:
+            value = self._attributes[path]
+            return list(value) if isinstance(value, tuple) else value
+        node = self.__node(path)
+        if _is_parameter(node):
+            return node.get("_value", default)
+        if node is None or isinstance(node, dict):
+            return default
+        return node
+
+    def find(self, path):
+        """Iterate over the Parameters matching a dotted path, * matches every child of an object
+
+        A path ending at an object yields every parameter below it.
+        """
+        parts = path.split(".")
+        if parts[0] == "*":
+            roots = [key for key in self._trees if not key.startswith("_")]
+        else:
+            roots = [parts[0]]
+        only = parts[1] if len(parts) > 1 and parts[1] != "*" else None
+        for root in roots:
+            for parameter in _find_parameters(self.__tree(root, only), root, parts[1:]):
+                yield parameter
+
+    def to_dict(self):
+        """Get the complete device document"""
+        document = {}
+        for key, value in self._attributes.items():
+            document[key] = list(value) if isinstance(value, tuple) else value
+        for key in self._trees:
+            document[key] = self.__tree(key)
+        return document
+
+    def __repr__(self):
+        return "Device(%r)" % self.id
+
+class Task(object):
+    """A task as returned by the NBI, fields other than _id, device, name and timestamp are in arguments"""
+    __slots__ = ("id", "device", "name", "timestamp", "arguments")
+
+    def __init__(self, document):
+        self.id = document.get("_id")
+        self.device = document.get("device")
+        self.name = document.get("name")
+        self.timestamp = document.get("timestamp")
+        self.arguments = {}
+        for key, value in document.items():
+            if key not in ("_id", "device", "name", "timestamp"):
+                self.arguments[key] = value
+
+    def to_dict(self):
+        """Get the task document"""
+        document = dict(self.arguments)
+        document.update({"_id": self.id, "device": self.device, "name": self.name, "timestamp": self.timestamp})
+        return document
+
+    def __repr__(self):
+        return "Task(%r, %r)" % (self.id, self.name)
+
+class Fault(object):
+    """A fault as returned by the NBI"""
+    __slots__ = ("id", "device", "channel", "code", "message", "detail", "timestamp", "retries")
+
+    def __init__(self, document):
+        self.id = document.get("_id")
+        self.device = document.get("device")
+        self.channel = document.get("channel")
+        self.code = document.get("code")
+        self.message = document.get("message")
+        self.detail = document.get("detail")
+        self.timestamp = document.get("timestamp")
+        self.retries = document.get("retries")
+
+    @property
+    def task_id(self):
+        """ID of the task which caused the fault, None for faults of other channels"""
+        if self.channel and self.channel.startswith("task_"):
+            return self.channel[5:]
+        return None
+
+    def to_dict(self):
+        """Get the fault document"""
+        return {"_id": self.id, "device": self.device, "channel": self.channel, "code": self.code,
+                "message": self.message, "detail": self.detail, "timestamp": self.timestamp, "retries": self.retries}
+
+    def __repr__(self):
+        return "Fault(%r, %r)" % (self.id, self.code)
+
+def _read_ordered(query, documents):
+    # an ordered Query is paged with skip, which misses documents when the
+    # result set changes while it is paged: read all of it before the
+    # caller changes anything
+    if isinstance(query, Query) and query.order:
+        return list(documents)
+    return documents
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _parallel_map(func, items, workers, rate_limiter=None):
+    # yield (item, func(item)) in order of completion, keeping at most twice
+    # the number of workers submitted so huge iterables are never materialized
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        for item in items:
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            pending[executor.submit(func, item)] = item
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+class RateLimiter(object):
+    """Token bucket limiting acquisitions to rate per second, allowing bursts of up to burst.
+
+    A RateLimiter is thread safe and can be shared between several bulk
+    calls to limit their combined request rate.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until the given number of tokens is available and take them"""
+        while True:
+            delay = self.try_acquire(tokens)
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def try_acquire(self, tokens=1):
+        """Take the tokens if they are available, otherwise return the seconds until they will be"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def release(self, tokens=1):
+        """Give back tokens which were taken but not used"""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+def _endpoint_template(url):
+    # "/devices/<id>/tags/<tag>?connection_request" -> "/devices/{id}/tags/{name}"
+    parts = [part for part in url.split("?", 1)[0].split("/") if part]
+    if len(parts) > 1:
+        parts[1] = "{id}"
+    if len(parts) > 3:
+        parts[3] = "{name}"
+    return "/" + "/".join(parts)
+
+class RequestMetrics(object):
+    """Measurements of one NBI request, passed to the hooks of a Connection.
+
+    endpoint is the URL path with IDs and names replaced by placeholders,
+    e.g. "/devices/{id}/tasks". status is None if no response was received.
+    All times are in seconds: connect is the time spent opening a new
+    connection (name lookup, TCP and TLS handshake, 0 for a reused one),
+    ttfb the time from sending the request to receiving the response
+    headers, total the time until the body was received and decoded and
+    decode the time spent parsing the JSON body.
+    """
+    __slots__ = ("method", "endpoint", "url", "status", "bytes_in", "bytes_out", "connect", "ttfb", "total", "decode")
+
+    def __init__(self, method, endpoint, url):
+        self.method = method
+        self.endpoint = endpoint
+        self.url = url
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connect = 0.0
+        self.ttfb = 0.0
+        self.total = 0.0
+        self.decode = 0.0
+
+class MetricsCollector(object):
+    """Thread safe aggregator of RequestMetrics, usable as Connection hook.
+
+    Counts requests and bytes and keeps a latency histogram of every phase
+    per method, endpoint and status. render() returns them in the
+    Prometheus text format, serve() exposes them over HTTP for scraping.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    PHASES = ("total", "connect", "ttfb", "decode")
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, metrics):
+        if metrics.status is None:
+            status = "error"
+        else:
+            status = str(metrics.status)
+        key = (metrics.method, metrics.endpoint, status)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"count": 0, "bytes_in": 0, "bytes_out": 0}
+                for phase in self.PHASES:
+                    series[phase] = [[0] * (len(self.buckets) + 1), 0.0]
+            series["count"] += 1
+            series["bytes_in"] += metrics.bytes_in
+            series["bytes_out"] += metrics.bytes_out
+            for phase in self.PHASES:
+                value = getattr(metrics, phase)
+                histogram = series[phase]
+                index = len(self.buckets)
+                for position, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        index = position
+                        break
+                histogram[0][index] += 1
+                histogram[1] += value
+
+    def reset(self):
+        """Forget all collected metrics"""
+        with self.lock:
+            self.series = {}
+
+    def render(self):
+        """Return the collected metrics in the Prometheus text exposition format"""
+        with self.lock:
+            series = sorted(self.series.items())
+        lines = []
+        for name, field, text in (("genieacs_requests_total", "count", "NBI requests"),
+                                  ("genieacs_request_bytes_received_total", "bytes_in", "Response bytes received from the NBI"),
+                                  ("genieacs_request_bytes_sent_total", "bytes_out", "Request bytes sent to the NBI")):
+            lines.append("# HELP " + name + " " + text)
+            lines.append("# TYPE " + name + " counter")
+            for key, values in series:
+                lines.append(name + "{" + _labels(key) + "} " + str(values[field]))
+        for phase in self.PHASES:
+            name = "genieacs_request_" + phase + "_seconds"
+            lines.append("# HELP " + name + " NBI request " + phase + " time")
+            lines.append("# TYPE " + name + " histogram")
+            for key, values in series:
+                counts, total = values[phase]
+                labels = _labels(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(name + "_bucket{" + labels + ",le=\"" + repr(float(bound)) + "\"} " + str(cumulative))
+                lines.append(name + "_bucket{" + labels + ",le=\"+Inf\"} " + str(values["count"]))
+                lines.append(name + "_sum{" + labels + "} " + repr(total))
+                lines.append(name + "_count{" + labels + "} " + str(values["count"]))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9464, host="127.0.0.1"):
+        """Serve render() at http://host:port/metrics from a background thread, return the server"""
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = collector.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+def _labels(key):
+    method, endpoint, status = key
+    return "method=\"" + method + "\",endpoint=\"" + endpoint.replace("\\", "\\\\").replace("\"", "\\\"") + "\",status=\"" + status + "\""
+
+class DeviceWatcher(object):
+    """Incremental feed of device changes based on _lastInform and _registered.
+
+    Every poll() only queries devices which informed or registered since the
+    highest timestamps seen so far and yields ("add", device) for new and
+    ("update", device) for known devices. With removals_every=n, every n-th
+    poll additionally lists all device IDs and yields ("remove", {"_id": id})
+    for devices which disappeared. The first poll yields every device as
+    added unless initial is False.
+
+    GenieACS sets _lastInform when a session starts but saves the device
+    when it ends, so a device can appear with a timestamp below the mark
+    after it was polled. Every poll therefore starts overlap seconds before
+    the mark, devices seen again unchanged are not reported twice.
+
+    projection selects the fields fetched for changed devices; _id,
+    _lastInform and _registered are always included. With checkpoint set to
+    a file name the watcher state is kept in an SQLite database there. Every
+    completed poll writes only the devices which changed, a restarted
+    watcher resumes where it stopped.
+    """
+    def __init__(self, connection, projection=None, checkpoint=None, removals_every=0, initial=True, page_size=1000,
+                 overlap=300):
+        self.connection = connection
+        fields = ["_id", "_lastInform", "_registered"]
+        if projection is not None:
+            if not isinstance(projection, (list, tuple)):
+                projection = projection.split(',')
+            fields += [field for field in projection if field not in fields]
+        self.projection = ",".join(fields)
+        self.checkpoint = checkpoint
+        self.removals_every = removals_every
+        self.initial = initial
+        self.page_size = page_size
+        self.overlap = overlap
+        self.last_inform = None
+        self.last_registered = None
+        self.polls = 0
+        # last seen _lastInform of every known device, and the IDs added,
+        # updated or removed since the last save
+        self.known = {}
+        self.dirty = set()
+        self.db = None
+        if checkpoint is not None:
+            self.db = sqlite3.connect(checkpoint)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS known (id TEXT PRIMARY KEY, last_inform TEXT);
+            """)
+            self.load()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def load(self):
+        """Restore the watcher state from the checkpoint database"""
+        state = dict(self.db.execute("SELECT key, value FROM state"))
+        self.last_inform = state.get("last_inform")
+        self.last_registered = state.get("last_registered")
+        self.polls = int(state.get("polls") or 0)
+        self.known = dict(self.db.execute("SELECT id, last_inform FROM known"))
+        self.dirty = set()
+
+    def save(self):
+        """Write the marks and the devices changed since the last save to the checkpoint database"""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                                [("last_inform", self.last_inform), ("last_registered", self.last_registered),
+                                 ("polls", str(self.polls))])
+            self.db.executemany("INSERT OR REPLACE INTO known VALUES (?, ?)",
+                                [(device_id, self.known[device_id]) for device_id in self.dirty
+                                 if device_id in self.known])
+            self.db.executemany("DELETE FROM known WHERE id = ?",
+                                [(device_id,) for device_id in self.dirty if device_id not in self.known])
+        self.dirty = set()
+
+    def poll(self):
+        """Yield (event, device) for every change since the last poll"""
+        # a first poll which was interrupted is continued as the first
+        first = self.polls == 0
+        query = None
+        if not first:
+            conditions = []
+            if self.last_inform is not None:
+                conditions.append({"_lastInform": {"$gte": _timestamp_before(self.last_inform, self.overlap)}})
+            if self.last_registered is not None:
+                conditions.append({"_registered": {"$gte": _timestamp_before(self.last_registered, self.overlap)}})
+            if conditions:
+                query = {"$or": conditions}
+        # devices come in _id order, the marks only move once all of them
+        # were seen, an interrupted poll is repeated from the old marks
+        max_inform, max_registered = self.last_inform, self.last_registered
+        for device in self.connection.device_iter(query, self.projection, self.page_size):
+            last_inform = device.get("_lastInform")
+            registered = device.get("_registered")
+            if last_inform is not None and (max_inform is None or last_inform > max_inform):
+                max_inform = last_inform
+            if registered is not None and (max_registered is None or registered > max_registered):
+                max_registered = registered
+            device_id = device["_id"]
+            if device_id not in self.known:
+                self.known[device_id] = last_inform
+                self.dirty.add(device_id)
+                if self.initial or not first:
+                    yield "add", device
+            elif self.known[device_id] != last_inform:
+                # devices within the overlap come again with the next
+                # poll, skip them if nothing changed
+                self.known[device_id] = last_inform
+                self.dirty.add(device_id)
+                yield "update", device
+        self.last_inform, self.last_registered = max_inform, max_registered
+        self.polls += 1
+        if not first and self.removals_every and self.polls % self.removals_every == 0:
+            current = set(self.connection.device_get_all_IDs())
+            for device_id in [device_id for device_id in self.known if device_id not in current]:
+                del self.known[device_id]
+                self.dirty.add(device_id)
+                yield "remove", {"_id": device_id}
+        if self.db is not None:
+            self.save()
+
+    def watch(self, interval=60):
+        """Poll forever, yielding the changes and waiting interval seconds between polls"""
+        while True:
+            started = time.time()
+            for change in self.poll():
+                yield change
+            time.sleep(max(0, interval - (time.time() - started)))
+
+class DeviceSnapshot(object):
+    """Local SQLite copy of the device fleet for fast offline queries.
+
+    refresh() pulls the devices (optionally only the fields in projection)
+    into the database at path. After the first run only devices which
+    informed or registered since the last refresh, less overlap seconds
+    for sessions saved late (see DeviceWatcher), are fetched; full=True
+    fetches everything again and drops devices deleted from the ACS. The
+    timestamps to continue from are only saved when a refresh completed,
+    an interrupted refresh is picked up by the next one.
+
+    Besides the JSON document the ID, MAC (summary.mac), serial number,
+    product class, OUI, _lastInform, _registered and the tags of every
+    device are stored in indexed columns. find() and count() filter on
+    them, query() runs arbitrary SQL against the tables devices and tags,
+    e.g. with json_extract() on the document column.
+    """
+    COLUMNS = "_id,_deviceId,_lastInform,_registered,_tags,summary.mac"
+
+    def __init__(self, path, projection=None, overlap=300):
+        self.path = path
+        self.overlap = overlap
+        self.projection = None
+        if projection is not None:
+            if not isinstance(projection, (list, tuple)):
+                projection = projection.split(',')
+            fields = self.COLUMNS.split(',')
+            self.projection = ",".join(fields + [field for field in projection if field not in fields])
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS devices (
+                id TEXT PRIMARY KEY,
+                mac TEXT,
+                serial TEXT,
+                product_class TEXT,
+                oui TEXT,
+                last_inform TEXT,
+                registered TEXT,
+                document TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tags (
+                tag TEXT NOT NULL,
+                device_id TEXT NOT NULL,
+                PRIMARY KEY (tag, device_id)
+            );
+            CREATE INDEX IF NOT EXISTS devices_mac ON devices (mac);
+            CREATE INDEX IF NOT EXISTS devices_serial ON devices (serial);
+            CREATE INDEX IF NOT EXISTS devices_product_class ON devices (product_class);
+            CREATE INDEX IF NOT EXISTS devices_last_inform ON devices (last_inform);
+            CREATE INDEX IF NOT EXISTS devices_registered ON devices (registered);
+            CREATE INDEX IF NOT EXISTS tags_device_id ON tags (device_id);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, connection, full=False, page_size=1000):
+        """Update the snapshot from the ACS, return the number of stored and removed devices"""
+        query = None
+        # the newest timestamps of the last completed refresh, and of this one
+        marks = {"last_inform": None, "last_registered": None}
+        if not full:
+            marks.update(self.db.execute("SELECT key, value FROM state"))
+            last_inform, registered = marks["last_inform"], marks["last_registered"]
+            conditions = []
+            if last_inform is not None:
+                conditions.append({"_lastInform": {"$gte": _timestamp_before(last_inform, self.overlap)}})
+            if registered is not None:
+                conditions.append({"_registered": {"$gte": _timestamp_before(registered, self.overlap)}})
+            if conditions:
+                query = {"$or": conditions}
+        if full:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM seen")
+        stored = 0
+        for chunk in _chunks(connection.device_iter(query, self.projection, page_size), page_size):
+            self.__store(chunk)
+            for device in chunk:
+                for mark, key in (("last_inform", "_lastInform"), ("last_registered", "_registered")):
+                    value = device.get(key)
+                    if value is not None and (marks[mark] is None or value > marks[mark]):
+                        marks[mark] = value
+            if full:
+                self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", [(device["_id"],) for device in chunk])
+            self.db.commit()
+            stored += len(chunk)
+        removed = 0
+        if full:
+            removed = self.db.execute("DELETE FROM devices WHERE id NOT IN (SELECT id FROM seen)").rowcount
+            self.db.execute("DELETE FROM tags WHERE device_id NOT IN (SELECT id FROM seen)")
+            self.db.execute("DROP TABLE seen")
+        self.db.executemany("INSERT OR REPLACE INTO state VALUES (?, ?)", marks.items())
+        self.db.commit()
+        return {"stored": stored, "removed": removed}
+
+    def __store(self, devices):
+        rows = []
+        tags = []
+        for device in devices:
+            device_id = device["_id"]
+            device_ids = device.get("_deviceId") or {}
+            mac = (device.get("summary") or {}).get("mac")
+            if isinstance(mac, dict):
+                mac = mac.get("_value")
+            rows.append((device_id, mac, device_ids.get("_SerialNumber"), device_ids.get("_ProductClass"),
+                         device_ids.get("_OUI"), device.get("_lastInform"), device.get("_registered"),
+                         json.dumps(device, separators=(',', ':'))))
+            for tag in device.get("_tags") or []:
+                tags.append((tag, device_id))
+        self.db.executemany("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.executemany("DELETE FROM tags WHERE device_id = ?", [(row[0],) for row in rows])
+        self.db.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?)", tags)
+
+    def __where(self, device_id, mac, serial, product_class, tag):
+        clauses = []
+        params = []
+        for column, value in (("id", device_id), ("mac", mac), ("serial", serial), ("product_class", product_class)):
+            if value is not None:
+                clauses.append(column + " = ?")
+                params.append(value)
+        if tag is not None:
+            clauses.append("id IN (SELECT device_id FROM tags WHERE tag = ?)")
+            params.append(tag)
+        if not clauses:
+            return "", params
+        return " WHERE " + " AND ".join(clauses), params
+
+    def find(self, device_id=None, mac=None, serial=None, product_class=None, tag=None, limit=None):
+        """Get the stored documents of all devices matching the given values"""
+        where, params = self.__where(device_id, mac, serial, product_class, tag)
+        sql = "SELECT document FROM devices" + where + " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT " + str(int(limit))
+        return [json.loads(row[0]) for row in self.db.execute(sql, params)]
+
+    def count(self, device_id=None, mac=None, serial=None, product_class=None, tag=None):
+        """Count the stored devices matching the given values"""
+        where, params = self.__where(device_id, mac, serial, product_class, tag)
+        return self.db.execute("SELECT COUNT(*) FROM devices" + where, params).fetchone()[0]
+
+    def query(self, sql, params=()):
+        """Run an SQL query against the snapshot and return all rows"""
+        return self.db.execute(sql, params).fetchall()
+
+class TaskTracker(object):
+    """Waits for many queued tasks at once and resolves a Future per task.
+
+    GenieACS removes a task once the device executed it, a faulty task
+    stays and gets a fault in the channel "task_<id>". Instead of polling
+    every device, poll() checks all pending tasks with one $in query on
+    /tasks and one on /faults per batch_size tasks. The Future of a task
+    returned by track() resolves to a dict with the keys "status"
+    (completed, faulted or timeout), "task" (the task ID) and "fault" (the
+    fault document of a faulted task).
+
+    run() polls until no task is pending, start() polls in a background
+    thread. The delay between polls starts at min_interval, doubles after
+    every poll which resolved nothing up to max_interval and drops back to
+    min_interval as soon as tasks resolve or new ones are tracked.
+    """
+    def __init__(self, connection, timeout=300, batch_size=200, min_interval=1, max_interval=30):
+        self.connection = connection
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        # task ID -> (Future, deadline)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+    def track(self, task, timeout=None, callback=None):
+        """Start tracking a task given by ID or as returned by a task_* method, return its Future
+
+        timeout overrides the timeout of the tracker for this task, callback
+        is called with the Future once the task resolves.
+        """
+        task_id = task["_id"] if isinstance(task, dict) else task
+        if timeout is None:
+            timeout = self.timeout
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        with self.lock:
+            self.pending[task_id] = (future, time.time() + timeout)
+            self.interval = self.min_interval
+        self.wakeup.set()
+        return future
+
+    def track_bulk(self, results, timeout=None, callback=None):
+        """Track the tasks created by task_bulk or task_bulk_iter, return a dict of Futures by device ID
+
+        Executed tasks resolve at once as completed, devices whose task
+        could not be created are left out.
+        """
+        if isinstance(results, dict):
+            results = results.items()
+        futures = {}
+        for device_id, result in results:
+            if result["status"] == "queued":
+                futures[device_id] = self.track(result["task"], timeout, callback)
+            elif result["status"] == "executed":
+                future = futures[device_id] = Future()
+                if callback is not None:
+                    future.add_done_callback(callback)
+                future.set_result({"status": "completed", "task": result["task"]["_id"], "fault": None})
+        return futures
+
+    def __resolve(self, task_id, status, fault=None):
+        with self.lock:
+            future, _ = self.pending.pop(task_id, (None, None))
+        if future is not None:
+            future.set_result({"status": status, "task": task_id, "fault": fault})
+
+    def poll(self):
+        """Check all pending tasks once, return the number of tasks resolved"""
+        with self.lock:
+            task_ids = list(self.pending)
+        resolved = 0
+        for chunk in _chunks(task_ids, self.batch_size):
+            queued = set()
+            for task in self.connection.task_iter({"_id": {"$in": chunk}}, "_id"):
+                queued.add(task["_id"])
+            faults = {}
+            channels = ["task_" + task_id for task_id in chunk]
+            for fault in self.connection.fault_iter({"channel": {"$in": channels}}):
+                faults[fault["channel"][5:]] = fault
+            now = time.time()
+            for task_id in chunk:
+                if task_id in faults:
+                    self.__resolve(task_id, "faulted", faults[task_id])
+                elif task_id not in queued:
+                    self.__resolve(task_id, "completed")
+                else:
+                    with self.lock:
+                        entry = self.pending.get(task_id)
+                    if entry is None or entry[1] > now:
+                        continue
+                    self.__resolve(task_id, "timeout")
+                resolved += 1
+        with self.lock:
+            if resolved:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+        return resolved
+
+    def __expire(self):
+        # resolve the tasks past their deadline without asking the NBI
+        now = time.time()
+        with self.lock:
+            expired = [task_id for task_id, (_, deadline) in self.pending.items() if deadline <= now]
+        for task_id in expired:
+            self.__resolve(task_id, "timeout")
+        return len(expired)
+
+    def __loop(self, forever):
+        while not self.stopped:
+            self.wakeup.clear()
+            if self.pending:
+                try:
+                    self.poll()
+                except (ConnectionError, requests.exceptions.RequestException):
+                    # the NBI is unavailable, back off as if nothing resolved
+                    # but still give up on the tasks which timed out
+                    self.__expire()
+                    with self.lock:
+                        self.interval = min(self.interval * 2, self.max_interval)
+            if not self.pending and not forever:
+                return
+            self.wakeup.wait(self.interval)
+
+    def run(self):
+        """Poll in the calling thread until no task is pending"""
+        self.__loop(False)
+
+    def start(self):
+        """Poll in a background thread until stop() is called"""
+        self.stopped = False
+        self.thread = threading.Thread(target=self.__loop, args=(True,), name="TaskTracker")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread, pending tasks stay tracked"""
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+class ConnectionRequestScheduler(object):
+    """Spreads the connection requests of a large task campaign over time.
+
+    submit() queues tasks client side. run_iter() posts them device by
+    device: all but the last task of a device without a connection request
+    and the last one with it, so every device is woken up once. Devices
+    are dispatched in order of priority (the highest priority of their
+    tasks, then first come first served) while the token buckets allow it:
+    rate limits the connection requests per second to the whole ACS (a
+    number or a shared RateLimiter), group_rates limits them per group, e.g.
+    {"r4500": 5}, and group_rate is the limit of groups not in group_rates.
+    A device is in the group given to submit(), otherwise in
+    group_by(device_id), e.g. a product class or subnet lookup. A group
+    without tokens does not hold up the others.
+
+    priorities maps task names to the priority of tasks submitted without
+    one, e.g. {"reboot": 10, "refreshObject": 0}, the default is 0.
+    """
+    def __init__(self, connection, rate=None, group_rates=None, group_rate=None, group_by=None, priorities=None,
+                 workers=8, burst=1):
+        self.connection = connection
+        if rate is not None and not isinstance(rate, RateLimiter):
+            rate = RateLimiter(rate, burst)
+        self.rate = rate
+        self.group_rates = group_rates or {}
+        self.group_rate = group_rate
+        self.group_by = group_by
+        self.priorities = priorities or {}
+        self.workers = workers
+        self.burst = burst
+        self.buckets = {}
+        # group -> heap of (-priority, sequence, device_id), device_id -> [priority, sequence, group, tasks]
+        self.queues = {}
+        self.devices = {}
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def submit(self, device_id, task, priority=None, group=None):
+        """Queue a task for a device, e.g. {"name": "reboot"}"""
+        if priority is None:
+            priority = self.priorities.get(task.get("name"), 0)
+        with self.lock:
+            entry = self.devices.get(device_id)
+            if entry is None:
+                if group is None and self.group_by is not None:
+                    group = self.group_by(device_id)
+                self.sequence += 1
+                entry = self.devices[device_id] = [priority, self.sequence, group, []]
+            elif priority <= entry[0]:
+                entry[3].append(task)
+                return
+            entry[0] = priority
+            entry[3].append(task)
+            # a raised priority leaves the old heap item behind, __next skips it
+            heapq.heappush(self.queues.setdefault(entry[2], []), (-priority, entry[1], device_id))
+
+    def submit_all(self, device_ids, task, priority=None, group=None):
+        """Queue a task for many devices"""
+        for device_id in device_ids:
+            self.submit(device_id, task, priority, group)
+
+    def __bucket(self, group):
+        if group not in self.buckets:
+            rate = self.group_rates.get(group, self.group_rate)
+            self.buckets[group] = RateLimiter(rate, self.burst) if rate is not None else None
+        return self.buckets[group]
+
+    def __next(self):
+        # return (device_id, tasks) of the next device to wake up, or
+        # (None, delay) if no bucket has a token yet, or (None, None) if the
+        # queue is empty
+        with self.lock:
+            heads = []
+            for group, queue in self.queues.items():
+                while queue:
+                    priority, sequence, device_id = queue[0]
+                    entry = self.devices.get(device_id)
+                    if entry is not None and entry[0] == -priority and entry[1] == sequence:
+                        break
+                    heapq.heappop(queue)
+                if queue:
+                    heads.append((queue[0], group))
+            if not heads:
+                return None, None
+            if self.rate is not None:
+                delay = self.rate.try_acquire()
+                if delay:
+                    return None, delay
+            heads.sort()
+            delays = []
+            for (priority, sequence, device_id), group in heads:
+                bucket = self.__bucket(group)
+                delay = bucket.try_acquire() if bucket is not None else 0
+                if not delay:
+                    heapq.heappop(self.queues[group])
+                    return device_id, self.devices.pop(device_id)[3]
+                delays.append(delay)
+            # the ACS token was taken but no group may send yet, give it back
+            if self.rate is not None:
+                self.rate.release()
+            return None, min(delays)
+
+    def __dispatch(self, device_id, tasks):
+        created = []
+        for index, task in enumerate(tasks):
+            result = self.connection.task_create(device_id, task, index == len(tasks) - 1)
+            if result["task"] is not None:
+                created.append(result["task"])
+            if result["status"] not in ("executed", "queued"):
+                break
+        return {"status": result["status"], "tasks": created, "error": result["error"]}
+
+    def run_iter(self):
+        """Wake up all queued devices, yield (device_id, result) as they finish
+
+        Up to workers devices are dispatched at once. Each result is a dict
+        with the keys "status" (of the last task, executed, queued,
+        not_found, timeout or error), "tasks" (the created tasks) and
+        "error". Tasks submitted while running are dispatched as well.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = {}
+        try:
+            while True:
+                device_id, item = self.__next()
+                if device_id is not None:
+                    pending[executor.submit(self.__dispatch, device_id, item)] = device_id
+                    if len(pending) < 2 * self.workers:
+                        continue
+                    timeout = None
+                elif item is not None:
+                    timeout = item
+                elif pending:
+                    timeout = None
+                else:
+                    return
+                if pending:
+                    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+                else:
+                    time.sleep(timeout)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def run(self):
+        """Wake up all queued devices, return a dict of results by device ID"""
+        return dict(self.run_iter())
+
+class _UploadReader(object):
+    # file wrapper handed to requests as request body: the upload is read in
+    # blocks, hashed and reported on the fly instead of loaded into memory
+    def __init__(self, f, progress=None):
+        self.f = f
+        self.progress = progress
+        self.md5 = hashlib.md5()
+        self.sent = 0
+        f.seek(0, os.SEEK_END)
+        self.size = f.tell()
+        f.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        block = self.f.read(size)
+        if block:
+            self.md5.update(block)
+            self.sent += len(block)
+            if self.progress is not None:
+                self.progress(self.sent, self.size)
+        return block
+
+class _CacheEntry(object):
+    __slots__ = ("resource", "data", "expires", "etag", "last_modified")
+
+    def __init__(self, resource, data, expires, etag, last_modified):
+        self.resource = resource
+        self.data = data
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+class _ResponseCache(object):
+    # thread safe LRU cache of decoded GET responses with a TTL per resource
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def ttl_for(self, resource):
+        if isinstance(self.ttl, dict):
+            return self.ttl.get(resource)
+        return self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.pop(key)
+                self.entries[key] = entry
+            return entry
+
+    def put(self, resource, key, data, etag=None, last_modified=None):
+        entry = _CacheEntry(resource, data, time.time() + self.ttl_for(resource), etag, last_modified)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, resource=None):
+        with self.lock:
+            if resource is None:
+                self.entries.clear()
+            else:
+                for key in [key for key, entry in self.entries.items() if entry.resource == resource]:
+                    del self.entries[key]
+
 class ConnectionError(Exception):
     def __str__(self):
         return "Could not (re-)connect to the ACS"
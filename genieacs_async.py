@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+#
+# python-genieacs
+# An asyncio API to interact with the GenieACS REST API
+# https://github.com/TDT-GmbH/python-genieacs
+
+import asyncio
+import json
+import time
+from urllib.parse import quote
+
+import aiohttp
+
+from genieacs import ConnectionError, InvalidRequestDataError
+from genieacs import _PING_PARAMS, _json_loads, _parameter_value, _parameter_values
+
+class AsyncConnection(object):
+    """Asynchronous connection object to interact with the GenieACS server.
+
+    Offers the same methods as genieacs.Connection as coroutines. At most
+    max_concurrency requests are in flight at any time, all of them sharing
+    one pool of keep-alive connections:
+
+        async with AsyncConnection("acs.example.com") as acs:
+            await asyncio.gather(*[acs.task_reboot(device_id) for device_id in device_ids])
+
+    Entering the context does no request unless probe is set, ping() tests
+    the connection explicitly.
+    """
+    def __init__(self, ip, port=7557, ssl=False, verify=False, auth=False, user="", passwd="", url="", timeout=10, max_concurrency=100,
+                 probe=False):
+        self.server_ip = ip
+        self.server_port = port
+        self.use_ssl = ssl
+        self.ssl_verify = verify
+        self.use_auth = auth
+        self.username = user
+        self.password = passwd
+        self.server_url = url
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.base_url = ""
+        self.session = None
+        self.semaphore = None
+        self.probe = probe
+        self.__set_base_url()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __set_base_url(self):
+        if not self.use_ssl:
+            self.base_url = "http://"
+        else:
+            self.base_url = "https://"
+        self.base_url += self.server_ip + ":" + str(self.server_port) + self.server_url
+
+    def __create_session(self):
+        if self.session is None:
+            if self.use_ssl and not self.ssl_verify:
+                connector = aiohttp.TCPConnector(limit=self.max_concurrency, ssl=False)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            auth = None
+            if self.use_auth:
+                auth = aiohttp.BasicAuth(self.username, self.password)
+            self.session = aiohttp.ClientSession(connector=connector, auth=auth,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def connect(self):
+        """Open the session, with probe set also do a request to test the connection"""
+        self.__create_session()
+        if self.probe:
+            await self.ping()
+
+    async def ping(self):
+        """Test the connection with a query for a single device ID, return the round trip time in seconds"""
+        started = time.time()
+        await self.__request_get("/devices/", _PING_PARAMS)
+        return time.time() - started
+
+    async def close(self):
+        """Close the session and all pooled connections"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __request(self, method, url, params=None, json_data=None, data=None, headers=None):
+        self.__create_session()
+        request_url = self.base_url + url
+        async with self.semaphore:
+            try:
+                async with self.session.request(method, request_url, params=params, json=json_data,
+                                                data=data, headers=headers) as r:
+                    r.raise_for_status()
+                    body = await r.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                raise ConnectionError
+        if body:
+            return _json_loads(body)
+
+    async def __request_get(self, url, params=None):
+        return await self.__request("GET", url, params=params)
+
+    async def __request_iter(self, url, query=None, projection=None, page_size=1000):
+        # same _id keyset pagination as Connection.device_iter
+        if query is not None and not isinstance(query, dict):
+            query = json.loads(query)
+        if isinstance(projection, (list, tuple)):
+            projection = ",".join(projection)
+        params = {"sort": json.dumps({"_id": 1}), "limit": page_size}
+        if projection:
+            params["projection"] = projection
+        page_query = query
+        while True:
+            if page_query:
+                params["query"] = json.dumps(page_query)
+            page = await self.__request_get(url, params)
+            if not page:
+                return
+            for document in page:
+                yield document
+            if len(page) < page_size:
+                return
+            after = {"_id": {"$gt": page[-1]["_id"]}}
+            if query:
+                page_query = {"$and": [query, after]}
+            else:
+                page_query = after
+
+    async def __request_post(self, url, data, conn_request=True):
+        if conn_request:
+            url += "?connection_request"
+        return await self.__request("POST", url, json_data=data)
+
+    async def __request_put(self, url, data, headers=None):
+        return await self.__request("PUT", url, data=data, headers=headers)
+
+    async def __request_delete(self, url):
+        return await self.__request("DELETE", url)
+
+    ##### methods for devices #####
+
+    def device_iter(self, query=None, projection=None, page_size=1000):
+        """Asynchronously iterate over all devices matching a query, fetching them page by page"""
+        return self.__request_iter("/devices/", query, projection, page_size)
+
+    async def device_get_all_IDs(self):
+        """Get IDs of all devices"""
+        data = []
+        async for device in self.device_iter(projection="_id"):
+            data.append(device["_id"])
+        return data
+
+    async def device_get_by_id(self, device_id):
+        """Get all data of a device identified by its ID"""
+        return await self.__request_get("/devices/", {"query": json.dumps({"_id": device_id})})
+
+    async def device_get_by_MAC(self, device_MAC):
+        """Get all data of a device identified by its MAC address"""
+        return await self.__request_get("/devices/", {"query": json.dumps({"summary.mac": device_MAC})})
+
+    async def device_get_by_serial(self, device_serial):
+        """Get all data of a device identified by its Serial"""
+        query = {"InternetGatewayDevice.DeviceInfo.SerialNumber": device_serial}
+        return await self.__request_get("/devices/", {"query": json.dumps(query)})
+
+    async def device_get_parameter(self, device_id, parameter_name):
+        """Directly get the value of a given parameter from a given device"""
+        data = await self.__request_get("/devices", {"query": json.dumps({"_id": device_id}), "projection": parameter_name})
+        return _parameter_value(data, parameter_name)
+
+    async def device_get_parameters(self, device_id, parameter_names, flat=False):
+        """Get a defined list of parameters from a given device, nested or (flat=True) keyed by parameter name"""
+        data = await self.__request_get("/devices", {"query": json.dumps({"_id": device_id}), "projection": parameter_names})
+        return _parameter_values(data, parameter_names, flat)
+
+    async def device_delete(self, device_id):
+        """Delete a given device from the database"""
+        await self.__request_delete("/devices/" + quote(device_id))
+
+    ##### methods for tasks #####
+
+    async def task_get_all(self, device_id=None):
+        """Get all existing tasks, optionally only those of a given device"""
+        if device_id:
+            return await self.__request_get("/tasks/", {"query": json.dumps({"device": device_id})})
+        else:
+            return await self.__request_get("/tasks/")
+
+    async def __task_create(self, device_id, data, conn_request):
+        return await self.__request_post("/devices/" + quote(device_id) + "/tasks", data, conn_request)
+
+    async def task_refresh_object(self, device_id, object_name, conn_request=True):
+        """Create a refreshObject task for a given device"""
+        data = { "name": "refreshObject",
+                 "objectName": object_name }
+        return await self.__task_create(device_id, data, conn_request)
+
+    async def task_set_parameter_values(self, device_id, parameter_values, conn_request=True):
+        """Create a setParameterValues task for a given device"""
+        data = { "name": "setParameterValues",
+                 "parameterValues": parameter_values }
+        return await self.__task_create(device_id, data, conn_request)
+
+    async def task_get_parameter_values(self, device_id, parameter_names, conn_request=True):
+        """Create a getParameterValues task for a given device"""
+        data = { "name": "getParameterValues",
+                 "parameterNames": parameter_names }
+        return await self.__task_create(device_id, data, conn_request)
+
+    async def task_add_object(self, device_id, object_name, object_path, conn_request=True):
+        """Create an addObject task for a given device"""
+        data = { "name": "addObject", object_name : object_path}
+        return await self.__task_create(device_id, data, conn_request)
+
+    async def task_reboot(self, device_id, conn_request=True):
+        """Create a reboot task for a given device"""
+        return await self.__task_create(device_id, { "name": "reboot"}, conn_request)
+
+    async def task_factory_reset(self, device_id, conn_request=True):
+        """Create a factoryReset task for a given device"""
+        return await self.__task_create(device_id, { "name": "factoryReset"}, conn_request)
+
+    async def task_download(self, device_id, file_id, filename, conn_request=True):
+        """Create a download task for a given device"""
+        data = { "name": "download", "file": file_id, "filename": filename}
+        return await self.__task_create(device_id, data, conn_request)
+
+    async def task_retry(self, task_id):
+        "Retry a faulty task at the next inform"
+        return await self.__request_post("/tasks/" + task_id + "/retry", None)
+
+    async def task_delete(self, task_id):
+        """Delete a Task for a given device"""
+        return await self.__request_delete("/tasks/" + task_id)
+
+    ##### methods for tags ######
+
+    async def tag_get_all(self, device_id):
+        """Get all existing tags of a given device"""
+        data = await self.__request_get("/devices", {"query": json.dumps({"_id": device_id}), "projection": "_tags"})
+        try:
+            return data[0]["_tags"]
+        except (IndexError, KeyError):
+            return []
+
+    async def tag_assign(self, device_id, tag_name):
+        """Assign a tag to a device"""
+        await self.__request_post("/devices/" + quote(device_id) + "/tags/" + tag_name, None, False)
+
+    async def tag_remove(self, device_id, tag_name):
+        """Remove a tag from a device"""
+        await self.__request_delete("/devices/" + quote(device_id) + "/tags/" + tag_name)
+
+    ##### methods for presets, objects and provisions #####
+
+    async def __get_all(self, collection, filename):
+        data = await self.__request_get("/" + collection)
+        try:
+            if filename is not None:
+                with open(filename, 'w') as f:
+                    json.dump(data, f, indent=4, separators=(',', ': '))
+        except IOError as err:
+            print(collection[:-1] + "_get_all:\nIOError: " + str(err) + "\n")
+        return data
+
+    async def __create_all_from_file(self, collection, filename):
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            coroutines = []
+            for item in data:
+                item_name = quote(item["_id"])
+                if collection == "provisions":
+                    item_data = item["script"]
+                else:
+                    del item["_id"]
+                    item_data = json.dumps(item)
+                coroutines.append(self.__request_put("/" + collection + "/" + item_name, item_data))
+            await asyncio.gather(*coroutines)
+        except IOError as err:
+            print(collection[:-1] + "_create_all_from_file:\nIOError: " + str(err) + "\n")
+        except ValueError:
+            print(collection[:-1] + "_create_all_from_file:\nValueError: File contains faulty values\n")
+        except KeyError:
+            print(collection[:-1] + "_create_all_from_file:\nKeyError: File contains faulty keys\n")
+
+    async def preset_get_all(self, filename=None):
+        """Get all existing presets as a json object, optionally write them to a file"""
+        return await self.__get_all("presets", filename)
+
+    async def preset_create(self, preset_name, data):
+        """Create a new preset or update a preset with a given name"""
+        await self.__request_put("/presets/" + quote(preset_name), data)
+
+    async def preset_create_all_from_file(self, filename):
+        """Create all presets contained in a json file"""
+        await self.__create_all_from_file("presets", filename)
+
+    async def preset_delete(self, preset_name):
+        """Delete a given preset"""
+        await self.__request_delete("/presets/" + quote(preset_name))
+
+    async def object_get_all(self, filename=None):
+        """Get all existing objects as a json object, optionally write them to a file"""
+        return await self.__get_all("objects", filename)
+
+    async def object_create(self, object_name, data):
+        """Create a new object or update an object with a given name"""
+        await self.__request_put("/objects/" + quote(object_name), data)
+
+    async def object_create_all_from_file(self, filename):
+        """Create all objects contained in a json file"""
+        await self.__create_all_from_file("objects", filename)
+
+    async def object_delete(self, object_name):
+        """Delete a given object"""
+        await self.__request_delete("/objects/" + quote(object_name))
+
+    async def provision_get_all(self, filename=None):
+        """Get all existing provisions as a json object, optionally write them to a file"""
+        return await self.__get_all("provisions", filename)
+
+    async def provision_create(self, provision_name, data):
+        """Create a new provision or update a provision with a given name"""
+        await self.__request_put("/provisions/" + quote(provision_name), data)
+
+    async def provision_create_all_from_file(self, filename):
+        """Create all provisions contained in a json file"""
+        await self.__create_all_from_file("provisions", filename)
+
+    async def provision_delete(self, provision_name):
+        """Delete a given provision"""
+        await self.__request_delete("/provisions/" + quote(provision_name))
+
+    ##### methods for files #####
+
+    async def file_upload(self, filename, fileType, oui, productClass, version):
+        """Upload or update a file"""
+        try:
+            with open(filename, "rb") as f:
+                await self.__request_put("/files/" + filename, data=f, headers={"fileType": fileType, "oui": oui, "productClass": productClass, "version" : version})
+        except IOError as err:
+            print("file_upload:\nIOError: " + str(err) + "\n")
+
+    async def file_delete(self, filename):
+        """Delete a given file"""
+        await self.__request_delete("/files/" + filename)
+
+    async def file_get_all(self):
+        """Get all files as a json object"""
+        return await self.__request_get("/files")
+
+    async def file_get(self, filename=None, fileType=None, oui=None, productClass=None, version=None):
+        """Get all data from one or several files"""
+        query = {}
+        if filename is not None:
+            query["filename"] = filename
+        else:
+            if fileType is not None:
+                query["metadata.fileType"] = fileType
+            if oui is not None:
+                query["metadata.oui"] = oui
+            if productClass is not None:
+                query["metadata.productClass"] = productClass
+            if version is not None:
+                query["metadata.version"] = version
+        if not query:
+            raise InvalidRequestDataError
+        return await self.__request_get("/files/", {"query": json.dumps(query)})
+
+    ##### methods for faults #####
+
+    def fault_iter(self, query=None, projection=None, page_size=1000):
+        """Asynchronously iterate over all faults matching a query, fetching them page by page"""
+        return self.__request_iter("/faults/", query, projection, page_size)
+
+    async def fault_get_all_IDs(self):
+        """Get IDs of all faults"""
+        data = []
+        async for fault in self.fault_iter(projection="_id"):
+            data.append(fault["_id"])
+        return data
+
+    async def fault_get_all(self, device_id=None):
+        """Get all existing faults, optionally only those of a given device"""
+        data = []
+        if device_id:
+            query = {"device": device_id}
+        else:
+            query = None
+        async for fault in self.fault_iter(query):
+            data.append(fault)
+        return data
+
+    async def fault_delete(self, fault_id):
+        """Delete a given fault"""
+        await self.__request_delete("/faults/" + quote(fault_id))
@@ -0,0 +1,400 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# python-genieacs
+# Command line tool for operations on many devices
+# https://github.com/TDT-GmbH/python-genieacs
+#
+#   python genieacs_cli.py --host acs.example.com task reboot --tag staged --rate 50
+#   python genieacs_cli.py --host acs.example.com tag --assign wave1 --remove staged --ids devices.csv
+#   python genieacs_cli.py --host acs.example.com params InternetGatewayDevice.DeviceInfo.SoftwareVersion < ids.txt
+#   python genieacs_cli.py --host acs.example.com export --product-class r4500 --output devices.jsonl
+#   python genieacs_cli.py --host acs.example.com sync --presets presets.json --delete --dry-run
+#
+# Devices are read from --ids (a text or CSV file, - for stdin), from stdin
+# if it is not a terminal, or selected with --query/--tag/--product-class.
+# Results are written as JSON lines. With --journal every finished device
+# is recorded, running the same command again skips the devices already
+# done, so an interrupted campaign resumes where it stopped.
+
+import argparse
+import csv
+import errno
+import json
+import os
+import sys
+import time
+
+import genieacs
+
+# statuses after which a device is not processed again on resume
+DONE = ("executed", "queued", "changed", "unchanged", "done", "not_found")
+
+
+class Progress(object):
+    """Live count, throughput and ETA on stderr"""
+
+    def __init__(self, total=None, enabled=True, interval=0.5):
+        self.total = total
+        self.enabled = enabled and sys.stderr.isatty()
+        self.interval = interval
+        self.count = 0
+        self.failed = 0
+        self.started = time.time()
+        self.shown = 0
+
+    def update(self, failed=False):
+        self.count += 1
+        if failed:
+            self.failed += 1
+        now = time.time()
+        if self.enabled and now - self.shown >= self.interval:
+            self.shown = now
+            self.show(now)
+
+    def show(self, now):
+        elapsed = max(now - self.started, 1e-6)
+        rate = self.count / elapsed
+        line = "%d" % self.count
+        if self.total:
+            line += "/%d" % self.total
+        line += " devices, %d failed, %.1f/s" % (self.failed, rate)
+        if self.total and rate:
+            line += ", ETA %s" % format_seconds(max(self.total - self.count, 0) / rate)
+        sys.stderr.write("\r" + line + " " * 8)
+        sys.stderr.flush()
+
+    def finish(self):
+        if self.enabled:
+            self.show(time.time())
+            sys.stderr.write("\n")
+        sys.stderr.write("%d devices, %d failed in %s\n" % (self.count, self.failed,
+                                                          format_seconds(time.time() - self.started)))
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Journal(object):
+    """Append-only record of finished devices, read back to resume a campaign"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by the interruption
+                        continue
+                    if entry.get("status") in DONE:
+                        self.done.add(entry["device"])
+        self.file = open(path, "a")
+        if self.file.tell() and not self.ends_with_newline(path):
+            self.file.write("\n")
+
+    @staticmethod
+    def ends_with_newline(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def pending(self, device_ids):
+        for device_id in device_ids:
+            if device_id not in self.done:
+                yield device_id
+
+    def record(self, device_id, status):
+        if self.file is not None:
+            self.file.write(json.dumps({"device": device_id, "status": status}) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def read_ids(f, column=None):
+    # one ID per line, or one column of a CSV file: an index, or a name
+    # looked up in the header row
+    reader = csv.reader(f)
+    index = 0
+    if column is not None:
+        if column.isdigit():
+            index = int(column)
+        else:
+            header = next(reader, [])
+            if column not in header:
+                raise SystemExit("column %s not in %s" % (column, ",".join(header)))
+            index = header.index(column)
+    for row in reader:
+        if len(row) > index and row[index].strip() and not row[index].startswith("#"):
+            yield row[index].strip()
+
+
+def device_query(args):
+    query = genieacs.Query(args.query)
+    if args.tag:
+        query = query.tag(args.tag)
+    if args.product_class:
+        query = query.product_class(args.product_class)
+    return query
+
+
+def device_source(acs, args):
+    """Return (device IDs, query, total): IDs from a file or stdin, or the IDs of the devices of a query"""
+    if args.ids or (args.query is None and not args.tag and not args.product_class and not sys.stdin.isatty()):
+        if args.ids in (None, "-"):
+            device_ids = list(read_ids(sys.stdin, args.column))
+        else:
+            with open(args.ids) as f:
+                device_ids = list(read_ids(f, args.column))
+        return device_ids, None, len(device_ids)
+    if args.query is None and not args.tag and not args.product_class:
+        raise SystemExit("select devices with --ids, --query, --tag or --product-class or pipe IDs to stdin")
+    query = device_query(args)
+    device_ids = (device["_id"] for device in acs.device_iter(query, "_id"))
+    return device_ids, query, acs.device_count(query)
+
+
+def parse_value(text):
+    # setParameterValues takes typed values, "true", "42" and the like are
+    # sent as JSON, anything else as a string
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def build_task(args):
+    if args.json:
+        return json.loads(args.json)
+    task = {"name": args.name}
+    if args.name == "refreshObject":
+        task["objectName"] = args.object or ""
+    elif args.name == "getParameterValues":
+        task["parameterNames"] = args.parameter
+    elif args.name == "setParameterValues":
+        task["parameterValues"] = []
+        for assignment in args.value:
+            name, _, value = assignment.partition("=")
+            task["parameterValues"].append([name, parse_value(value)])
+    elif args.name == "download":
+        task["file"] = args.file
+        task["filename"] = args.filename or args.file
+    return task
+
+
+##### commands #####
+# each yields (device_id, output record) for every finished device
+
+def cmd_task(acs, args, device_ids, query):
+    task = build_task(args)
+    results = acs.task_bulk_iter(task, device_ids, conn_request=not args.no_connection_request,
+                                 workers=args.workers, rate=args.rate)
+    for device_id, result in results:
+        yield device_id, {"device": device_id, "status": result["status"],
+                          "task": (result["task"] or {}).get("_id"), "error": result["error"]}
+
+
+def cmd_tag(acs, args, device_ids, query):
+    if not args.assign and not args.remove:
+        raise SystemExit("give --assign or --remove")
+    results = acs.tag_bulk_iter(args.assign, args.remove, device_ids, chunk_size=args.chunk_size,
+                                workers=args.workers, rate=args.rate)
+    for device_id, result in results:
+        record = {"device": device_id}
+        record.update(result)
+        yield device_id, record
+
+
+def cmd_params(acs, args, device_ids, query):
+    results = acs.device_iter_parameters(device_ids, args.parameters, chunk_size=args.chunk_size,
+                                         workers=args.workers, flat=True)
+    for device_id, values in results:
+        yield device_id, {"device": device_id, "status": "done" if values else "not_found", "parameters": values}
+
+
+def cmd_export(acs, args, device_ids, query):
+    projection = args.projection
+    if query is not None:
+        # stream the documents straight from the query instead of by ID
+        for document in acs.device_iter(query, projection, args.chunk_size):
+            if document["_id"] not in args.journal_done:
+                yield document["_id"], document
+        return
+    fields = projection.split(",") if projection else None
+    if fields and "_id" not in fields:
+        fields.append("_id")
+    for chunk in genieacs._chunks(device_ids, args.chunk_size):
+        found = set()
+        for document in acs.device_iter(genieacs.Query().ids(chunk), fields, args.chunk_size):
+            found.add(document["_id"])
+            yield document["_id"], document
+        for device_id in chunk:
+            if device_id not in found:
+                yield device_id, None
+
+
+def run_devices(acs, args, command):
+    journal = Journal(args.journal)
+    args.journal_done = journal.done
+    device_ids, query, total = device_source(acs, args)
+    if total is not None:
+        total = max(total - len(journal.done), 0)
+    if args.command != "export" or query is None:
+        device_ids = journal.pending(device_ids)
+    progress = Progress(total, not args.quiet)
+    out = open(args.output, "a" if args.journal else "w") if args.output else sys.stdout
+    failed = 0
+    try:
+        for device_id, record in command(acs, args, device_ids, query):
+            if record is None:
+                status = "not_found"
+            elif args.command == "export":
+                status = "done"
+                out.write(json.dumps(record) + "\n")
+            else:
+                status = record["status"]
+                out.write(json.dumps(record) + "\n")
+            if status not in DONE:
+                failed += 1
+            journal.record(device_id, status)
+            progress.update(status not in DONE)
+    except KeyboardInterrupt:
+        sys.stderr.write("\ninterrupted" + (", run again with the same --journal to resume\n" if args.journal else "\n"))
+        failed += 1
+    except IOError as err:
+        # the reader of stdout went away, e.g. head
+        if err.errno != errno.EPIPE:
+            raise
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        progress.finish()
+        journal.close()
+        if out is not sys.stdout:
+            out.close()
+        else:
+            out.flush()
+    return 1 if failed else 0
+
+
+def load_config(path):
+    # a missing or malformed file ends the command before anything is changed
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            items = json.load(f)
+    except (IOError, OSError) as err:
+        raise SystemExit("can not read %s: %s" % (path, err.strerror or err))
+    except ValueError as err:
+        raise SystemExit("%s is not valid JSON: %s" % (path, err))
+    if not isinstance(items, list) or not all(isinstance(item, dict) and "_id" in item for item in items):
+        raise SystemExit("%s must hold a list of objects with an _id" % path)
+    return items
+
+
+def run_sync(acs, args):
+    presets, objects, provisions = load_config(args.presets), load_config(args.objects), load_config(args.provisions)
+    report = acs.config_sync(presets, objects, provisions, args.delete, args.dry_run, args.workers)
+    failed = 0
+    for result in report.values():
+        failed += len(result["failed"])
+    out = open(args.output, "w") if args.output else sys.stdout
+    out.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    if out is not sys.stdout:
+        out.close()
+    return 1 if failed else 0
+
+
+def add_device_options(parser):
+    group = parser.add_argument_group("devices")
+    group.add_argument("--ids", help="file with one device ID per line or a CSV file, - for stdin")
+    group.add_argument("--column", help="CSV column with the device IDs, an index or a header name")
+    group.add_argument("--query", help="device query as JSON")
+    group.add_argument("--tag", help="devices with this tag")
+    group.add_argument("--product-class", help="devices of this product class")
+    parser.add_argument("--workers", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--rate", type=float, help="tasks or tag changes per second")
+    parser.add_argument("--chunk-size", type=int, default=100, help="devices fetched per request")
+    parser.add_argument("--output", help="write the JSON lines to this file instead of stdout")
+    parser.add_argument("--journal", help="record finished devices in this file and skip them when run again")
+    parser.add_argument("--quiet", action="store_true", help="do not show the progress")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GenieACS operations on many devices")
+    parser.add_argument("--host", default=os.environ.get("GENIEACS_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("GENIEACS_PORT", 7557)))
+    parser.add_argument("--ssl", action="store_true")
+    parser.add_argument("--verify", action="store_true", help="verify the TLS certificate")
+    parser.add_argument("--user", default=os.environ.get("GENIEACS_USER"))
+    parser.add_argument("--password", default=os.environ.get("GENIEACS_PASSWORD"))
+    parser.add_argument("--url", default="", help="path prefix of the NBI")
+    parser.add_argument("--timeout", type=float, default=10)
+    subparsers = parser.add_subparsers(dest="command")
+
+    task = subparsers.add_parser("task", help="create a task for every device")
+    task.add_argument("name", choices=["reboot", "factoryReset", "refreshObject", "getParameterValues",
+                               "setParameterValues", "download"])
+    task.add_argument("--object", help="object name of refreshObject")
+    task.add_argument("--parameter", action="append", default=[], help="parameter of getParameterValues")
+    task.add_argument("--value", action="append", default=[], help="NAME=VALUE of setParameterValues")
+    task.add_argument("--file", help="file ID of download")
+    task.add_argument("--filename", help="file name of download, defaults to the file ID")
+    task.add_argument("--json", help="the complete task as JSON, overrides the other task options")
+    task.add_argument("--no-connection-request", action="store_true", help="leave the tasks for the next inform")
+    add_device_options(task)
+    task.set_defaults(func=cmd_task)
+
+    tag = subparsers.add_parser("tag", help="assign and remove tags")
+    tag.add_argument("--assign", action="append", default=[])
+    tag.add_argument("--remove", action="append", default=[])
+    add_device_options(tag)
+    tag.set_defaults(func=cmd_tag)
+
+    params = subparsers.add_parser("params", help="read parameters of every device")
+    params.add_argument("parameters", nargs="+")
+    add_device_options(params)
+    params.set_defaults(func=cmd_params)
+
+    export = subparsers.add_parser("export", help="export the device documents as JSON lines")
+    export.add_argument("--projection", help="comma separated fields to export")
+    add_device_options(export)
+    export.set_defaults(func=cmd_export)
+
+    sync = subparsers.add_parser("sync", help="make presets, objects and provisions match JSON files")
+    sync.add_argument("--presets")
+    sync.add_argument("--objects")
+    sync.add_argument("--provisions")
+    sync.add_argument("--delete", action="store_true", help="delete items missing in the files")
+    sync.add_argument("--dry-run", action="store_true", help="only report what would change")
+    sync.add_argument("--workers", type=int, default=8, help="changes applied at once")
+    sync.add_argument("--output", help="write the report to this file instead of stdout")
+    sync.set_defaults(func=None)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("choose a command")
+    acs = genieacs.Connection(args.host, port=args.port, ssl=args.ssl, verify=args.verify, auth=bool(args.user),
+                              user=args.user or "", passwd=args.password or "", url=args.url, timeout=args.timeout,
+                              pool_maxsize=max(10, args.workers))
+    try:
+        if args.command == "sync":
+            return run_sync(acs, args)
+        return run_devices(acs, args, args.func)
+    except genieacs.ConnectionError:
+        sys.stderr.write("can not reach the NBI at %s\n" % acs.base_url)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+#
+# python-genieacs
+# A fake GenieACS NBI serving synthetic data for benchmarks and local testing
+# https://github.com/TDT-GmbH/python-genieacs
+
+import argparse
+import bisect
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qs, unquote
+except ImportError:
+    raise ImportError("mocknbi requires Python 3.7 or newer")
+
+
+def _timestamp(seconds_ago=0):
+    moment = datetime.datetime(2026, 1, 1) - datetime.timedelta(seconds=seconds_ago)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _parameter(value, writable=False, seconds_ago=0):
+    return {"_value": value, "_timestamp": _timestamp(seconds_ago), "_writable": writable}
+
+
+def synthetic_device(index, rng=None):
+    """Build a synthetic device document shaped like the ones GenieACS stores"""
+    rng = rng or random
+    product_class = "r%d" % (4500 + index % 4 * 100)
+    serial = "%012X" % (0x000149000000 + index)
+    mac = ":".join("%02x" % b for b in (0x00, 0x01, 0x49, (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff))
+    last_inform = rng.randint(0, 7 * 86400)
+    device = {
+        "_id": "000149-%s-%s" % (product_class, serial),
+        "_deviceId": {
+            "_Manufacturer": "TDT GmbH",
+            "_OUI": "000149",
+            "_ProductClass": product_class,
+            "_SerialNumber": serial,
+        },
+        "_registered": _timestamp(30 * 86400 + index),
+        "_lastInform": _timestamp(last_inform),
+        "_lastBoot": _timestamp(last_inform + 3600),
+        "_tags": ["batch%d" % (index % 10)] + (["staged"] if index % 7 == 0 else []),
+        "summary": {"mac": _parameter(mac)},
+        "InternetGatewayDevice": {
+            "DeviceInfo": {
+                "Manufacturer": _parameter("TDT GmbH"),
+                "ProductClass": _parameter(product_class),
+                "SerialNumber": _parameter(serial),
+                "SoftwareVersion": _parameter("2.%d.%d" % (index % 3, index % 5)),
+                "HardwareVersion": _parameter("1.0"),
+                "UpTime": _parameter(rng.randint(0, 10 ** 6)),
+            },
+            "ManagementServer": {
+                "PeriodicInformInterval": _parameter(3600, True),
+                "ConnectionRequestURL": _parameter("http://10.%d.%d.%d:7547/" % ((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)),
+            },
+            "WANDevice": {"1": {"WANConnectionDevice": {"1": {"WANIPConnection": {
+                "1": {
+                    "ExternalIPAddress": _parameter("100.64.%d.%d" % ((index >> 8) & 0xff, index & 0xff)),
+                    "MACAddress": _parameter(mac),
+                    "Enable": _parameter(True, True),
+                },
+            }}}}},
+            "LANDevice": {"1": {"Hosts": {"Host": dict(
+                (str(n), {"HostName": _parameter("host-%d" % n), "IPAddress": _parameter("192.168.1.%d" % (100 + n))})
+                for n in range(1, 1 + index % 6)
+            )}}},
+        },
+    }
+    return device
+
+
+def _resolve(document, path):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return None, False
+    if isinstance(value, dict) and "_value" in value:
+        value = value["_value"]
+    return value, True
+
+
+def _compare(value, condition):
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$in":
+                if isinstance(value, list):
+                    if not any(item in operand for item in value):
+                        return False
+                elif value not in operand:
+                    return False
+            elif operator == "$nin":
+                if isinstance(value, list):
+                    if any(item in operand for item in value):
+                        return False
+                elif value in operand:
+                    return False
+            elif operator == "$ne":
+                if value == operand or (isinstance(value, list) and operand in value):
+                    return False
+            elif operator == "$eq":
+                if not _compare(value, operand):
+                    return False
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                try:
+                    if operator == "$gt" and not value > operand:
+                        return False
+                    if operator == "$gte" and not value >= operand:
+                        return False
+                    if operator == "$lt" and not value < operand:
+                        return False
+                    if operator == "$lte" and not value <= operand:
+                        return False
+                except TypeError:
+                    return False
+            elif operator == "$exists":
+                if bool(operand) != (value is not None):
+                    return False
+            elif operator == "$regex":
+                if value is None or not re.search(operand, str(value)):
+                    return False
+            else:
+                raise ValueError("unsupported operator " + operator)
+        return True
+    if isinstance(value, list):
+        return condition in value
+    return value == condition
+
+
+def match(document, query):
+    """Evaluate the subset of MongoDB query syntax the NBI clients use"""
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(match(document, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(match(document, sub) for sub in condition):
+                return False
+        else:
+            value, _ = _resolve(document, key)
+            if not _compare(value, condition):
+                return False
+    return True
+
+
+def project(document, projection):
+    if not projection:
+        return document
+    result = {"_id": document["_id"]}
+    for path in projection:
+        parts = path.split(".")
+        src = document
+        for part in parts:
+            if not isinstance(src, dict) or part not in src:
+                src = None
+                break
+            src = src[part]
+        if src is None:
+            continue
+        dest = result
+        for part in parts[:-1]:
+            dest = dest.setdefault(part, {})
+        dest[parts[-1]] = src
+    return result
+
+
+class MockNBI(object):
+    """In-process fake of the GenieACS NBI
+
+    Serves synthetic devices, tasks, faults, presets, objects, provisions and
+    files from memory over HTTP/1.1 with keep-alive. latency adds a fixed
+    delay (seconds) to every request, online_ratio is the share of devices
+    answering connection requests (their tasks are executed immediately and
+    answered with 200, the others stay queued and are answered with 202).
+    """
+
+    def __init__(self, devices=1000, faults=0, latency=0.0, online_ratio=1.0, host="127.0.0.1", port=0, seed=1):
+        rng = random.Random(seed)
+        self.latency = latency
+        self.online_ratio = online_ratio
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.collections = {
+            "devices": {},
+            "tasks": {},
+            "faults": {},
+            "presets": {},
+            "objects": {},
+            "provisions": {},
+            "files": {},
+        }
+        self.file_data = {}
+        self.next_task = 0
+        for index in range(devices):
+            device = synthetic_device(index, rng)
+            self.collections["devices"][device["_id"]] = device
+        device_ids = sorted(self.collections["devices"])
+        for index in range(faults):
+            device_id = device_ids[index % len(device_ids)]
+            task = self.__add_task(device_id, {"name": "download", "file": "firmware-%d.img" % (index % 3)})
+            channel = "task_" + task["_id"]
+            self.collections["faults"][device_id + ":" + channel] = {
+                "_id": device_id + ":" + channel,
+                "device": device_id,
+                "channel": channel,
+                "code": ("cwmp.9010", "cwmp.9002", "timeout")[index % 3],
+                "message": "Download failed",
+                "detail": None,
+                "timestamp": _timestamp(rng.randint(0, 3 * 86400)),
+                "retries": index % 4,
+            }
+        self.server = ThreadingHTTPServer((host, port), self.__handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mocknbi")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __add_task(self, device_id, task):
+        self.next_task += 1
+        task = dict(task)
+        task["_id"] = "%024x" % self.next_task
+        task["device"] = device_id
+        task["timestamp"] = _timestamp()
+        self.collections["tasks"][task["_id"]] = task
+        return task
+
+    def __handler(self):
+        nbi = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                nbi._handle(self, "GET")
+
+            def do_HEAD(self):
+                nbi._handle(self, "HEAD")
+
+            def do_POST(self):
+                nbi._handle(self, "POST")
+
+            def do_PUT(self):
+                nbi._handle(self, "PUT")
+
+            def do_DELETE(self):
+                nbi._handle(self, "DELETE")
+
+        return Handler
+
+    @staticmethod
+    def _reply(handler, status, body=None, headers=None, head=False):
+        if body is None:
+            payload = b""
+        elif isinstance(body, bytes):
+            payload = body
+        else:
+            payload = json.dumps(body).encode("utf-8")
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        if body is not None and not isinstance(body, bytes):
+            handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        if not head:
+            handler.wfile.write(payload)
+
+    def _handle(self, handler, method):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(handler.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query, keep_blank_values=True).items())
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        try:
+            status, data, headers = self.__route(method, parts, params, body, handler.headers)
+        except (ValueError, KeyError) as err:
+            status, data, headers = 400, str(err).encode("utf-8"), {}
+        self._reply(handler, status, data, headers, head=(method == "HEAD"))
+
+    def __route(self, method, parts, params, body, headers):
+        if not parts or parts[0] not in self.collections:
+            return 404, None, {}
+        name = parts[0]
+        collection = self.collections[name]
+        if len(parts) == 1 and method in ("GET", "HEAD"):
+            return self.__query(name, params)
+        if name == "files" and len(parts) == 2:
+            return self.__file(method, parts[1], body, headers)
+        with self.lock:
+            if name == "devices" and len(parts) >= 3:
+                device = collection.get(parts[1])
+                if device is None:
+                    return 404, None, {}
+                if parts[2] == "tasks" and method == "POST":
+                    task = self.__add_task(parts[1], json.loads(body.decode("utf-8")))
+                    if "connection_request" in params and random.random() < self.online_ratio:
+                        del self.collections["tasks"][task["_id"]]
+                        return 200, task, {}
+                    return 202, task, {}
+                if parts[2] == "tags" and len(parts) == 4:
+                    tags = device.setdefault("_tags", [])
+                    if method == "POST" and parts[3] not in tags:
+                        tags.append(parts[3])
+                    elif method == "DELETE" and parts[3] in tags:
+                        tags.remove(parts[3])
+                    return 200, None, {}
+            if name == "tasks" and len(parts) == 3 and parts[2] == "retry" and method == "POST":
+                if parts[1] not in collection:
+                    return 404, None, {}
+                for fault_id in [f for f, fault in self.collections["faults"].items() if fault["channel"] == "task_" + parts[1]]:
+                    del self.collections["faults"][fault_id]
+                return 200, None, {}
+            if len(parts) == 2 and method == "DELETE":
+                if collection.pop(parts[1], None) is None:
+                    return 404, None, {}
+                return 200, None, {}
+            if len(parts) == 2 and method == "PUT" and name in ("presets", "objects", "provisions"):
+                if name == "provisions":
+                    document = {"_id": parts[1], "script": body.decode("utf-8")}
+                else:
+                    document = json.loads(body.decode("utf-8"))
+                    document["_id"] = parts[1]
+                collection[parts[1]] = document
+                return 200, None, {}
+        return 405, None, {}
+
+    def __candidates(self, collection, query):
+        # narrow down the documents to scan for _id lookups and _id ranges,
+        # the queries keyset paging and batched fetches produce
+        conditions = [query] + [sub for sub in query.get("$and", []) if isinstance(sub, dict)]
+        for condition in conditions:
+            value = condition.get("_id")
+            if isinstance(value, str):
+                return [collection[value]] if value in collection else []
+            if isinstance(value, dict) and "$in" in value:
+                return [collection[key] for key in sorted(set(value["$in"])) if key in collection]
+            if isinstance(value, dict) and ("$gt" in value or "$gte" in value):
+                keys = sorted(collection)
+                if "$gt" in value:
+                    start = bisect.bisect_right(keys, value["$gt"])
+                else:
+                    start = bisect.bisect_left(keys, value["$gte"])
+                return [collection[key] for key in keys[start:]]
+        return [collection[key] for key in sorted(collection)]
+
+    def __query(self, name, params):
+        query = json.loads(params["query"]) if params.get("query") else {}
+        sort = list(json.loads(params.get("sort") or "{}").items())
+        skip = int(params.get("skip") or 0)
+        limit = int(params.get("limit") or 0)
+        with self.lock:
+            candidates = self.__candidates(self.collections[name], query)
+            documents = [document for document in candidates if match(document, query)]
+        if sort != [("_id", 1)]:
+            for field, direction in reversed(sort):
+                documents.sort(key=lambda document: (_resolve(document, field)[0] is None, _resolve(document, field)[0]),
+                               reverse=direction < 0)
+        total = len(documents)
+        documents = documents[skip:]
+        if limit:
+            documents = documents[:limit]
+        projection = [path for path in (params.get("projection") or "").split(",") if path]
+        return 200, [project(document, projection) for document in documents], {"X-Total-Count": str(total)}
+
+    def __file(self, method, filename, body, headers):
+        files = self.collections["files"]
+        with self.lock:
+            if method == "PUT":
+                files[filename] = {
+                    "_id": filename,
+                    "filename": filename,
+                    "length": len(body),
+                    "md5": hashlib.md5(body).hexdigest(),
+                    "uploadDate": _timestamp(),
+                    "metadata": {
+                        "fileType": headers.get("fileType"),
+                        "oui": headers.get("oui"),
+                        "productClass": headers.get("productClass"),
+                        "version": headers.get("version"),
+                    },
+                }
+                self.file_data[filename] = body
+                return 201, None, {}
+            if method == "DELETE":
+                if files.pop(filename, None) is None:
+                    return 404, None, {}
+                del self.file_data[filename]
+                return 200, None, {}
+            if method in ("GET", "HEAD"):
+                if filename not in self.file_data:
+                    return 404, None, {}
+                return 200, self.file_data[filename], {"Content-Type": "application/octet-stream"}
+        return 405, None, {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake GenieACS NBI serving synthetic data")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7557)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--faults", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every request in seconds")
+    parser.add_argument("--online-ratio", type=float, default=1.0, help="share of devices answering connection requests")
+    args = parser.parse_args()
+    nbi = MockNBI(args.devices, args.faults, args.latency, args.online_ratio, args.host, args.port)
+    print("listening on %s:%d" % (args.host, nbi.port), flush=True)
+    try:
+        nbi.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()